@@ -28,21 +28,71 @@
 
 import os
 import sys
+import stat
 import time
+import math
 import random
-
+import sqlite3
+import hashlib
+import threading
+import traceback
+import Queue
+import multiprocessing
+import json
+import struct
+import heapq
+import mmap
+import select
+import socket
+import StringIO
+
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from ConfigParser import SafeConfigParser
 import ctypes
 
-from ctypes import windll
-
-from win32con import *
-import win32gui
-import win32api
-import win32con
-
-from PIL import Image, ImageDraw, ImageChops, ImageOps, ImageFilter
+try:
+    from ctypes import windll
+except ImportError:
+    # Not on windows, only the headless backend will work.
+    windll = None
+
+try:
+    # Much faster listing on windows shares, where it gets the size and
+    # mtime with the names.
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# The rest of PIL (ImageDraw, ImageOps...) is imported where it's used, so
+# a run that doesn't crop or draw gradients doesn't pay for loading it.
+from PIL import Image
+
+# PIL's own decompression bomb check, as it was before setPixelLimit.
+pilMaxImagePixels = Image.MAX_IMAGE_PIXELS
+
+# What PIL raises for an image it can't decode. Only these get an image
+# marked broken (see isDecodeError and ImageIndex.markBroken), anything
+# else may well work next time.
+decodeErrors = (IOError, SyntaxError, Image.DecompressionBombError)
+
+def isDecodeError(e):
+    # IOError is also what Python 2 raises when the file can't be read at
+    # all, a share that's gone or a file deleted since it was indexed. Those
+    # carry an errno, PIL's own don't.
+    if isinstance(e, EnvironmentError) and e.errno is not None:
+        return False
+    return isinstance(e, decodeErrors)
+
+def setPixelLimit(maxPixels):
+    # With MaxPixels on, image sizes are checked against it before anything
+    # is decoded (see Desktop.limitDecode), PIL's own check would refuse the
+    # huge JPEGs that can still be decoded at a reduced size. With it off,
+    # PIL's check is all there is.
+    if maxPixels > 0:
+        Image.MAX_IMAGE_PIXELS = None
+    else:
+        Image.MAX_IMAGE_PIXELS = pilMaxImagePixels
 
 
 # I recommend you create a pywallpaper.conf file that looks something
@@ -66,6 +116,70 @@ Crop = False
 Fill = True
 Gradient = False
 PreRotate = True
+# Optional, where the image index lives (relative to the working dir)
+IndexFile = pywallpaper.db
+AspectMatch = False
+AspectTolerance = 0.15
+# Optional, rendered wallpaper cache, size in megabytes. RAW entries are
+# several times the size of PNG ones but a hit is pasted without
+# decoding anything.
+RenderCache = True
+RenderCacheDir = pywallpaper_cache
+RenderCacheSize = 512
+RenderCacheFormat = PNG
+# Optional, how many wallpapers to render ahead of time for each monitor
+# in timed mode, each one held in memory (0 = render it when it is due)
+Prefetch = 1
+# Optional, seconds between checks for monitors being added, removed or
+# moved in timed mode (0 = only when the wallpaper changes)
+TopologyPoll = 5
+# Optional, seconds between checks for this file changing in timed mode,
+# it is re-read without restarting (0 = never)
+ConfigPoll = 5
+# Optional, minutes between rescans of each image directory in timed mode
+# (0 = only when a wallpaper is chosen from it)
+RescanInterval = 10
+# Optional, include the images in subdirectories of the image directories
+Recursive = False
+# Optional, threads listing the image directories and reading new images,
+# and seconds before giving up on a directory for now (slow shares)
+CrawlThreads = 8
+CrawlTimeout = 60
+# Optional, only show the biggest of each set of near identical images
+# (resized or recompressed copies), DedupDistance is how many bits of their
+# 64 bit perceptual hashes can differ
+Dedup = False
+DedupDistance = 6
+# Optional, answer commands on this localhost port in timed mode, send
+# them with --send (0 = off)
+ControlPort = 0
+# Optional, processes used to render the monitors in parallel (0 = off)
+RenderProcesses = 0
+# Optional, once the wallpaper is up in one-shot mode (-t 0) render the
+# next one, so the next run only has to put it up
+PrerenderNext = False
+# Optional, decode at a reduced size when the monitor is smaller
+FastLoad = True
+# Optional, megapixels an image may decode to (0 = no limit), bigger JPEGs
+# are decoded at a reduced size and anything else is skipped, and
+# megabytes of images being decoded at once across the render processes
+MaxPixels = 100
+DecodeMemory = 1024
+# Optional, scale and tint without full size intermediate images
+FusedRender = True
+# Optional, BMP, JPEG (Windows 7 and later) or PNG
+OutputFormat = BMP
+OutputQuality = 95
+# Optional, append a JSON line of counters and stage timings for every
+# wallpaper change to this file (see --stats)
+# MetricsFile = pywallpaper_metrics.jsonl
+# Optional, build the wallpaper a band at a time from per-monitor tiles
+# kept in TileDir, for very large desktops (BMP output only)
+Streaming = False
+TileDir = pywallpaper_tiles
+# Optional, render for the monitors in this JSON file instead of the ones
+# attached (see HeadlessBackend), -l on the command line does the same.
+# Layout = C:\pywallpaper\layout.json
 
 [directories]
 paths = C:\Documents and Settings\akm\My Documents\My Pictures\gb
@@ -75,6 +189,11 @@ paths = C:\Documents and Settings\akm\My Documents\My Pictures\gb
 paths = C:\Documents and Settings\akm\My Documents\My Pictures\Wide Screen
 [monitor_1]
 paths = C:\Documents and Settings\akm\My Documents\My Pictures\Landscapes
+# Optional, minutes between changes for this monitor in timed mode
+interval = 30
+# A monitor can have just an interval, it uses the global paths.
+[monitor_2]
+interval = 5
 """
 
 # If you don't like the little dos window that pops you can use the
@@ -118,69 +237,2136 @@ class MONITORINFO(ctypes.Structure):
         ]
 
 class Monitor(object):
-    def __init__(self, monitor, physical, working, flags):
-        self.monitor = monitor
-        self.physical = physical
-        self.working = working
-        self.size = self.getSize(*self.physical)
-        self.width, self.height = self.size
-        self.left, self.top, self.right, self.bottom = self.physical
-        self._left, self._top, self._right, self._bottom = self.physical
+    """ A monitor's place on the desktop, and on the wallpaper image """
+
+    # Windows tiles a multi-monitor wallpaper from the primary monitor's
+    # top left corner, so a monitor at (left, top) on the desktop shows
+    # the wallpaper image from ((left - primary left) % width, (top -
+    # primary top) % height), where width and height are the whole
+    # desktop's. A monitor that runs off the right or bottom of the image
+    # wraps round, and is split into two or four parts (see placements).
+    # Monitors are immutable and compare and hash by their geometry, so a
+    # layout can be a cache key. The backends make them with the wallpaper
+    # the size of the monitor, Layout places them on the real one.
+
+    __slots__ = ('monitor', 'physical', 'working', 'isPrimary', 'left',
+                 'top', 'right', 'bottom', 'width', 'height', 'size', 'key',
+                 'origin', 'wallSize', 'position', 'needsSplit',
+                 'placements')
+
+    def __init__(self, monitor, physical, working, flags, origin = None,
+                 wallSize = None):
+        physical = tuple(map(int, physical))
+        left, top, right, bottom = physical
+        width, height = abs(right - left), abs(bottom - top)
+        if origin is None:
+            origin = (left, top)
+        if wallSize is None:
+            wallSize = (width, height)
+        x = (left - origin[0]) % wallSize[0]
+        y = (top - origin[1]) % wallSize[1]
+
+        # The parts are (box in our wallpaper, where it goes on the image),
+        # from (start, end, where) across and then down.
+        columns = [(0, width, x)]
+        if x + width > wallSize[0]:
+            columns = [(0, wallSize[0] - x, x), (wallSize[0] - x, width, 0)]
+        rows = [(0, height, y)]
+        if y + height > wallSize[1]:
+            rows = [(0, wallSize[1] - y, y), (wallSize[1] - y, height, 0)]
+        placements = tuple(((x0, y0, x1, y1), (toX, toY))
+                           for y0, y1, toY in rows
+                           for x0, x1, toX in columns)
+
+        for name, value in (
+                ('monitor', monitor), ('physical', physical),
+                ('working', tuple(map(int, working))),
+                ('isPrimary', flags != 0), ('left', left), ('top', top),
+                ('right', right), ('bottom', bottom), ('width', width),
+                ('height', height), ('size', (width, height)),
+                # Which monitor this is from one layout to the next.
+                ('key', physical),
+                ('origin', tuple(origin)), ('wallSize', tuple(wallSize)),
+                ('position', (x, y)), ('needsSplit', len(placements) > 1),
+                ('placements', placements)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Monitor is immutable")
+
+    def __reduce__(self):
+        # For the render processes.
+        return (Monitor, (self.monitor, self.physical, self.working,
+                          int(self.isPrimary), self.origin, self.wallSize))
+
+    def place(self, origin, wallSize):
+        """ This monitor on a wallpaper of wallSize tiled from origin """
+        return Monitor(self.monitor, self.physical, self.working,
+                       int(self.isPrimary), origin, wallSize)
+
+    def getGeometry(self):
+        return (self.physical, self.working, self.isPrimary, self.origin,
+                self.wallSize)
+
+    def __eq__(self, other):
+        return (isinstance(other, Monitor) and
+                self.getGeometry() == other.getGeometry())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.getGeometry())
+
+    def addWallpaper(self, bgImage, wallpaper):
+        if not self.needsSplit:
+            bgImage.paste(wallpaper, self.position)
+            return
+
+        for box, position in self.placements:
+            part = wallpaper.crop(box)
+            part.load()
+            bgImage.paste(part, position)
+
+    def getWallpaper(self, bgImage):
+        """ Cut our wallpaper back out of a desktop image """
+        if not self.needsSplit:
+            x, y = self.position
+            return bgImage.crop((x, y, x + self.width, y + self.height))
+
+        wallpaper = Image.new(bgImage.mode, self.size)
+        for (left, top, right, bottom), (x, y) in self.placements:
+            wallpaper.paste(bgImage.crop((x, y, x + right - left,
+                                          y + bottom - top)), (left, top))
+        return wallpaper
+
+    def __repr__(self):
+        return 'extent: ' + str(self.physical) + ' :: size: ' + str(self.size) + ' :: primary: ' + str(self.isPrimary) + ' :: needsSplit ' + str(self.needsSplit) + ':: ' + hex(self.monitor)
+
+class Layout(object):
+    """ The monitors, placed on the wallpaper image that covers them all """
+
+    # The image is the size of the desktop's bounding box and tiled from
+    # the primary monitor, wherever that is (see Monitor). Everything is
+    # worked out in one go when the layout is made.
+
+    __slots__ = ('monitors', 'size', 'origin')
+
+    def __init__(self, monitors):
+        if not monitors:
+            raise Exception("No monitors")
+        primary = None
+        left, top, right, bottom = monitors[0].physical
+        for m in monitors:
+            if primary is None and m.isPrimary:
+                primary = m
+            left = min(left, m.left)
+            top = min(top, m.top)
+            right = max(right, m.right)
+            bottom = max(bottom, m.bottom)
+        if primary is None:
+            primary = monitors[0]
+        size = (right - left, bottom - top)
+        origin = (primary.left, primary.top)
+        for name, value in (
+                ('monitors', tuple(m.place(origin, size) for m in monitors)),
+                ('size', size), ('origin', origin)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Layout is immutable")
+
+    def __reduce__(self):
+        return (Layout, (self.monitors,))
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and self.monitors == other.monitors
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.monitors)
+
+class Win32Backend(object):
+    """ Finds the monitors and sets the wallpaper through the win32 API """
+
+    # From win32con, which takes longer to import than the wallpaper takes
+    # to put up when it's ready (see Desktop.setPrerendered). pywin32 is
+    # only imported for the registry.
+    SM_CXSCREEN = 0
+    SM_CYSCREEN = 1
+    SM_XVIRTUALSCREEN = 76
+    SM_YVIRTUALSCREEN = 77
+    SM_CXVIRTUALSCREEN = 78
+    SM_CYVIRTUALSCREEN = 79
+    SM_CMONITORS = 80
+    SPI_SETDESKWALLPAPER = 20
+    SPIF_UPDATEINIFILE = 1
+    SPIF_SENDWININICHANGE = 2
+    MOVEFILE_REPLACE_EXISTING = 1
+
+    def findMonitors(self):
+        retval = []
+        CBFUNC = ctypes.WINFUNCTYPE(ctypes.c_int, ctypes.c_ulong, ctypes.c_ulong, ctypes.POINTER(RECT), ctypes.c_double)
+        def cb(hMonitor, hdcMonitor, lprcMonitor, dwData):
+            r = lprcMonitor.contents
+            data = [hMonitor]
+            data.append(r.dump())
+            retval.append(data)
+            return 1
+        cbfunc = CBFUNC(cb)
+        temp = windll.user32.EnumDisplayMonitors(0, 0, cbfunc, 0)
+        return retval
+
+    def getMonitors(self):
+        retval = []
+        for hMonitor, extents in self.findMonitors():
+            # data = [hMonitor]
+            mi = MONITORINFO()
+            mi.cbSize = ctypes.sizeof(MONITORINFO)
+            mi.rcMonitor = RECT()
+            mi.rcWork = RECT()            
+            res = windll.user32.GetMonitorInfoA(hMonitor, ctypes.byref(mi))
+            data = Monitor(hMonitor, mi.rcMonitor.dump(), mi.rcWork.dump(), mi.dwFlags)
+            retval.append(data)
+        return retval
+
+    def getDesktopColour(self):
+        dc = windll.user32.GetSysColor(1)
+        return ((dc & 0xFF  ),
+                (dc & 0xFF00) >> 8,
+                (dc & 0xFF0000) >> 16)
+
+    def setWallpaperStyleSingle(self):
+        import win32api, win32con
+        # 0x80000001 == HKEY_CURRENT_USER
+        k = win32api.RegOpenKeyEx(win32con.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,win32con.KEY_SET_VALUE)
+        win32api.RegSetValueEx(k, "WallpaperStyle", 0, win32con.REG_SZ, "0")
+        win32api.RegSetValueEx(k, "TileWallpaper", 0, win32con.REG_SZ, "0")
+
+    def setWallpaperStyleMulti(self):
+        # To set a multi-monitor wallpaper, we need to tile it...
+        import win32api, win32con
+        # 0x80000001 == HKEY_CURRENT_USER
+        k = win32api.RegOpenKeyEx(win32con.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,win32con.KEY_SET_VALUE)
+        win32api.RegSetValueEx(k, "WallpaperStyle", 0, win32con.REG_SZ, "0")
+        win32api.RegSetValueEx(k, "TileWallpaper", 0, win32con.REG_SZ, "1")
+
+    def setWallpaperStyle(self, multiMonitor):
+        if multiMonitor:
+            self.setWallpaperStyleMulti()
+        else:
+            self.setWallpaperStyleSingle()
+
+    def getFingerprint(self):
+        """ Cheap to read, and changes whenever the monitor layout does """
+        # Docking, undocking or moving a monitor changes the monitor count,
+        # the primary's resolution or the virtual screen's extents.
+        metrics = (self.SM_CMONITORS,
+                   self.SM_CXSCREEN, self.SM_CYSCREEN,
+                   self.SM_XVIRTUALSCREEN, self.SM_YVIRTUALSCREEN,
+                   self.SM_CXVIRTUALSCREEN, self.SM_CYVIRTUALSCREEN)
+        return tuple(windll.user32.GetSystemMetrics(m) for m in metrics)
+
+    def setWallpaper(self, pathToImage):
+        # Set it and make sure windows remembers the wallpaper we set.
+        result = windll.user32.SystemParametersInfoA(
+            self.SPI_SETDESKWALLPAPER, 0,
+            pathToImage,
+            self.SPIF_UPDATEINIFILE | self.SPIF_SENDWININICHANGE)
         
-        self.isPrimary = (flags != 0)
+        if not result:
+            raise Exception("Unable to set wallpaper.")
 
-        self.cTop = self.top
-        if self.cTop < 0:
-            self.cTop = 20000  + self.cTop
-        self.cLeft = self.left
-        if self.cLeft < 0:
-            self.cLeft  = 20000  + self.cLeft
+class HeadlessBackend(object):
+    """ A monitor layout from a file, wallpapers are only written out """
+
+    # For rendering somewhere other than the desktop it's for, e.g. batch
+    # rendering on a server or profiling on a build machine. The layout is
+    # JSON, rectangles are left, top, right, bottom in desktop coordinates
+    # with the primary monitor at 0, 0 just as windows reports them:
+    #
+    # {"colour": [0, 0, 0],
+    #  "monitors": [{"rect": [0, 0, 1920, 1080], "primary": true},
+    #               {"rect": [-1080, -420, 0, 1500]}]}
+
+    def __init__(self, layout, pathToLayout = None):
+        self.layout = layout
+        self.pathToLayout = pathToLayout
+        self.loaded = self.getFingerprint()
+
+    @classmethod
+    def fromFile(cls, pathToLayout):
+        # -w changes directory after the layout is loaded.
+        return cls(cls.loadLayout(pathToLayout),
+                   os.path.abspath(pathToLayout))
+
+    @staticmethod
+    def loadLayout(pathToLayout):
+        f = open(pathToLayout, 'rb')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def getFingerprint(self):
+        # Editing the layout file is our equivalent of docking.
+        if self.pathToLayout is None:
+            return None
+        try:
+            st = os.stat(self.pathToLayout)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
 
-        self.wLeft = int(self.left)
-        self.wTop = int(self.top)
+    def getMonitors(self):
+        fingerprint = self.getFingerprint()
+        if fingerprint != self.loaded and fingerprint is not None:
+            try:
+                self.layout = self.loadLayout(self.pathToLayout)
+                self.loaded = fingerprint
+            except (IOError, ValueError):
+                # Half written, we'll get it next time.
+                print >> sys.stderr, "Couldn't reload %s" % self.pathToLayout
+        retval = []
+        for n, m in enumerate(self.layout['monitors']):
+            physical = [int(i) for i in m['rect']]
+            working = [int(i) for i in m.get('work', physical)]
+            retval.append(Monitor(n, physical, working,
+                                  int(bool(m.get('primary')))))
+        return retval
 
-        self.needsSplit = ( (self.left < 0 and self.right > 0) or
-                            (self.top < 0 and self.bottom > 0) )
-        if self.needsSplit:
-            self.needVSplit = self.top < 0 and self.bottom > 0
-            self.needHSplit = self.left < 0 and self.right > 0
+    def getDesktopColour(self):
+        return tuple(self.layout.get('colour', (0, 0, 0)))
+
+    def setWallpaperStyle(self, multiMonitor):
+        pass
+
+    def setWallpaper(self, pathToImage):
+        # Already written out, which is all there is to do.
+        pass
+
+class ImageIndex(object):
+    """ Persistent index of the images in the wallpaper directories """
+
+    # Listing a directory with 100k photos on a network share and then
+    # opening files until one decodes is slow, so we keep what we know
+    # about every image in a small sqlite database. Directories are only
+    # listed again when their mtime changes and files are only re-read
+    # when their mtime or size changes, so picking a wallpaper is a query.
+
+    def __init__(self, pathToIndex):
+        self.pathToIndex = pathToIndex
+        # Only one thread uses the index at a time, but it may not be the
+        # one that opened it (see WallpaperDaemon).
+        self.db = sqlite3.connect(pathToIndex, check_same_thread = False)
+        # Paths are byte strings under python 2, keep them that way.
+        self.db.text_factory = str
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime REAL,
+                generation INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS images (
+                path TEXT PRIMARY KEY,
+                dir TEXT,
+                mtime REAL,
+                size INTEGER,
+                width INTEGER,
+                height INTEGER,
+                orientation INTEGER,
+                format TEXT
+            );
+            CREATE INDEX IF NOT EXISTS images_dir ON images (dir);
+        """)
+        self.addColumn('dirs', 'generation', 'INTEGER DEFAULT 0')
+        # Subdirectories seen when the directory was last listed, one per
+        # line, so a recursive crawl needn't list unchanged directories.
+        self.addColumn('dirs', 'subdirs', 'TEXT')
+        # Where the picture is inside any border, see Desktop.cropBorders.
+        self.addColumn('images', 'cropbox', 'TEXT')
+        # Perceptual hash, and the best copy of the image when there are
+        # near duplicates (see groupDuplicates).
+        self.addColumn('images', 'dhash', 'INTEGER')
+        self.addColumn('images', 'dupgroup', 'TEXT')
+        self.db.commit()
+
+    def addColumn(self, table, column, definition):
+        # Indexes written by older versions won't have newer columns.
+        columns = [r[1] for r in self.db.execute('PRAGMA table_info(%s)'
+                                                 % (table))]
+        if column not in columns:
+            self.db.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                            % (table, column, definition))
+
+    @staticmethod
+    def readImageHeader(pathToImage):
+        # Image.open only parses the header, nothing is decoded until
+        # load() so this is cheap even for huge images.
+        try:
+            image = Image.open(pathToImage)
+        except Exception:
+            # Not an image (or one PIL can't read) it stays in the index
+            # without dimensions so that we never try it again.
+            return (None, None, None, None)
 
-    def addWallpaper(self, bgImage, wallpaper):
-        if not self.needsSplit:
-            bgImage.paste(wallpaper, (self.wLeft, self.wTop))
+        try:
+            width, height = image.size
+            orientation = 1
+            try:
+                exif = image._getexif() or {}
+                orientation = exif.get(0x0112, 1)
+            except Exception:
+                pass
+            return (width, height, orientation, image.format)
+        finally:
+            image.close()
+
+    @staticmethod
+    def readImageHash(pathToImage, maxPixels = 0, budget = None):
+        """ 64 bit difference hash of an image, None if it won't decode """
+        # Each bit is whether a pixel of a 9x8 thumbnail is darker than the
+        # one to its right, so resized or recompressed copies of a picture
+        # land a few bits apart. JPEGs only decode at an eighth of the size
+        # (or less) for it. Raises ValueError if it would still decode to
+        # more than maxPixels.
+        try:
+            image = Image.open(pathToImage)
+        except Exception:
+            return None
+        try:
+            try:
+                image.draft('L', (64, 64))
+            except Exception:
+                return None
+            width, height = image.size
+            if maxPixels and width * height > maxPixels:
+                raise ValueError("%s is over MaxPixels" % (pathToImage))
+            cost = width * height * 4
+            if budget is not None:
+                budget.acquire(cost)
+            try:
+                small = image.convert('L').resize((9, 8), Image.BOX)
+            except Exception:
+                return None
+            finally:
+                if budget is not None:
+                    budget.release(cost)
+        finally:
+            image.close()
+
+        pixels = list(small.getdata())
+        value = 0
+        for y in range(8):
+            for x in range(8):
+                value = (value << 1) | (pixels[y * 9 + x] <
+                                        pixels[y * 9 + x + 1])
+        # sqlite integers are signed.
+        if value >= 1 << 63:
+            value -= 1 << 64
+        return value
+
+    def update(self, dirs, force = False, recursive = False):
+        for pathToDir in dirs:
+            self.updateDirectory(pathToDir, force, recursive)
+
+    def updateDirectory(self, pathToDir, force = False, recursive = False):
+        """ Bring the index up to date with a directory """
+        # One step after another here, DirectoryCrawler spreads them over
+        # threads and does lots of directories at once.
+        lastMtime, subdirs = self.getDirectory(pathToDir)
+        listing = self.scanDirectory(pathToDir, lastMtime, subdirs, force)
+        if listing is None:
             return
+        dirMtime, files, subdirs = listing
+        rows = []
+        if files is not None:
+            changed = self.getChangedFiles(files,
+                                           self.getKnownFiles(pathToDir),
+                                           force)
+            rows = self.readHeaders(pathToDir, changed)
+        self.applyListing(pathToDir, dirMtime, files, rows, subdirs)
+        if recursive:
+            self.update(subdirs, force, recursive)
+
+    def getDirectory(self, pathToDir):
+        """ (mtime, subdirectories) when the directory was last listed """
+        row = self.db.execute('SELECT mtime, subdirs FROM dirs WHERE '
+                              'path = ?', (pathToDir,)).fetchone()
+        if row is None:
+            return (None, [])
+        return (row[0], row[1] and row[1].split('\n') or [])
+
+    def getKnownFiles(self, pathToDir):
+        known = {}
+        for path, mtime, size in self.db.execute(
+                'SELECT path, mtime, size FROM images WHERE dir = ?',
+                (pathToDir,)):
+            known[path] = (mtime, size)
+        return known
+
+    def getUnhashed(self, pathToDir):
+        return [r[0] for r in self.db.execute(
+            'SELECT path FROM images WHERE dir = ? AND width IS NOT NULL '
+            'AND dhash IS NULL', (pathToDir,))]
+
+    def setHashes(self, rows):
+        """ Store (hash, path) from hashImages """
+        # An image that won't decode for the hash won't for a wallpaper.
+        self.db.executemany('UPDATE images SET width = NULL, height = NULL '
+                            'WHERE path = ?',
+                            [(path,) for value, path in rows if value is None])
+        self.db.executemany('UPDATE images SET dhash = ? WHERE path = ?',
+                            [r for r in rows if r[0] is not None])
+        self.db.commit()
+
+    def groupDuplicates(self, distance):
+        """ Group images whose hashes are within distance bits of each other """
+        # Returns (groups, images hidden). Comparing every pair is too slow
+        # for a big library, but split the hash into distance + 1 bands and
+        # any two within distance must match exactly in at least one, so
+        # only images sharing a band value need comparing. Each group's
+        # representative is its biggest image, the rest of the group point
+        # at it through dupgroup. Directories whose groups change get a new
+        # generation so their decks are dealt again.
+        rows = self.db.execute(
+            'SELECT path, dir, dhash, width * height, size, dupgroup '
+            'FROM images WHERE dhash IS NOT NULL AND width IS NOT NULL '
+            'ORDER BY path').fetchall()
+        hashes = [r[2] & 0xFFFFFFFFFFFFFFFF for r in rows]
+        # Flat colours and plain gradients hash to (nearly) all 0s or all
+        # 1s whatever they look like, so leave them out of it.
+        plain = [not distance < bin(h).count('1') < 64 - distance
+                 for h in hashes]
+        parent = range(len(rows))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        bands = distance + 1
+        for band in range(bands):
+            shift = band * 64 // bands
+            mask = (1 << ((band + 1) * 64 // bands - shift)) - 1
+            buckets = {}
+            for i, value in enumerate(hashes):
+                if not plain[i]:
+                    buckets.setdefault((value >> shift) & mask, []).append(i)
+            for members in buckets.itervalues():
+                for n, i in enumerate(members):
+                    for j in members[n + 1:]:
+                        a, b = find(i), find(j)
+                        if (a != b and
+                            bin(hashes[i] ^ hashes[j]).count('1') <= distance):
+                            parent[b] = a
+
+        groups = {}
+        for i in range(len(rows)):
+            groups.setdefault(find(i), []).append(i)
+        groupOf = [None] * len(rows)
+        count = hidden = 0
+        for members in groups.itervalues():
+            if len(members) < 2:
+                continue
+            count += 1
+            hidden += len(members) - 1
+            best = max(members, key = lambda i: (rows[i][3], rows[i][4],
+                                                 rows[i][0]))
+            for i in members:
+                groupOf[i] = rows[best][0]
+
+        changed = [(groupOf[i], rows[i][0]) for i in range(len(rows))
+                   if groupOf[i] != rows[i][5]]
+        self.db.executemany('UPDATE images SET dupgroup = ? WHERE path = ?',
+                            changed)
+        dirs = set(rows[i][1] for i in range(len(rows))
+                   if groupOf[i] != rows[i][5])
+        self.db.executemany('UPDATE dirs SET generation = generation + 1 '
+                            'WHERE path = ?', [(d,) for d in dirs])
+        self.db.commit()
+        return count, hidden
+
+    def hasImages(self, pathToDir, recursive = False, dedup = False):
+        match, args = self.getDirMatch(pathToDir, recursive)
+        if dedup:
+            match += ' AND NOT (%s)' % (self.duplicate)
+        return self.db.execute('SELECT 1 FROM images WHERE %s AND width IS '
+                               'NOT NULL LIMIT 1' % (match),
+                               args).fetchone() is not None
+
+    # These only touch the file system so any thread can use them.
+
+    @staticmethod
+    def listDirectory(pathToDir):
+        """ ([(path, mtime, size)], [subdirectory]) for a directory """
+        files = []
+        subdirs = []
+        if scandir is not None:
+            for entry in scandir(pathToDir):
+                try:
+                    if entry.is_dir():
+                        # A link could loop back on itself.
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append((entry.path, st.st_mtime, st.st_size))
+                except OSError:
+                    continue
+            return files, subdirs
+
+        for f in os.listdir(pathToDir):
+            path = os.path.join(pathToDir, f)
+            try:
+                st = os.stat(path)
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.islink(path):
+                        subdirs.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    files.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                continue
+        return files, subdirs
 
-        if self.needVSplit:
-            height = -self.top
-            bottom = wallpaper.crop((0, 0, self.width, height))
-            bottom.load()
-            top = wallpaper.crop((0, height, self.width, self.height))
-            top.load()
-            bgImage.paste(top, (self.wLeft, 0))
-            bgImage.paste(bottom, (self.wLeft, bgImage.size[1] - height))
+    @classmethod
+    def scanDirectory(cls, pathToDir, lastMtime, subdirs, force = False):
+        """ (mtime, [(path, mtime, size)], [subdirectory]) for a directory """
+        # None if it can't be read, the files are None if it hasn't
+        # changed since it was last listed.
+        try:
+            dirMtime = os.stat(pathToDir).st_mtime
+            if dirMtime == lastMtime and not force:
+                return (dirMtime, None, subdirs)
+            files, subdirs = cls.listDirectory(pathToDir)
+        except OSError:
+            # Share not mounted, directory moved... use what we have.
+            return None
+        # Thumbs.db and friends.
+        files = [f for f in files if not f[0].endswith('.db')]
+        return (dirMtime, files, sorted(subdirs))
+
+    @staticmethod
+    def getChangedFiles(files, known, force = False):
+        if force:
+            return list(files)
+        return [(path, mtime, size) for path, mtime, size in files
+                if known.get(path) != (mtime, size)]
+
+    @classmethod
+    def readHeaders(cls, pathToDir, files):
+        """ Index rows for files, for applyListing """
+        return [(path, pathToDir, mtime, size) + cls.readImageHeader(path)
+                for path, mtime, size in files]
+
+    @classmethod
+    def hashImages(cls, paths, maxPixels = 0, budget = None):
+        """ (hash, path) for images, for setHashes """
+        rows = []
+        for path in paths:
+            try:
+                rows.append((cls.readImageHash(path, maxPixels, budget),
+                             path))
+            except ValueError:
+                # Too big to decode, it's left unhashed for now.
+                continue
+        return rows
+
+    def applyListing(self, pathToDir, dirMtime, files, rows, subdirs):
+        """ Write what scanDirectory and readHeaders found to the index """
+        if files is None:
+            return
+        row = self.db.execute('SELECT generation, subdirs FROM dirs '
+                              'WHERE path = ?', (pathToDir,)).fetchone()
+        generation = row and row[0] or 0
+        oldSubdirs = row and row[1] and row[1].split('\n') or []
+
+        # Replacing the row forgets anything worked out from the old file,
+        # like its cropbox.
+        self.db.executemany('INSERT OR REPLACE INTO images (path, dir, '
+                            'mtime, size, width, height, orientation, '
+                            'format) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+        seen = set(f[0] for f in files)
+        gone = [(path,) for path in self.getKnownFiles(pathToDir)
+                if path not in seen]
+        self.db.executemany('DELETE FROM images WHERE path = ?', gone)
+
+        # Anything under a subdirectory that's gone is gone too.
+        for subdir in set(oldSubdirs) - set(subdirs):
+            match, args = self.getDirMatch(subdir, True)
+            self.db.execute('DELETE FROM images WHERE ' + match, args)
+            match, args = self.getDirMatch(subdir, True, 'path')
+            self.db.execute('DELETE FROM dirs WHERE ' + match, args)
+
+        # The generation tells the rotation decks the images have changed.
+        if rows or gone:
+            generation += 1
+        self.db.execute('INSERT OR REPLACE INTO dirs (path, mtime, '
+                        'generation, subdirs) VALUES (?, ?, ?, ?)',
+                        (pathToDir, dirMtime, generation,
+                         '\n'.join(subdirs)))
+        self.db.commit()
+
+    def getDirMatch(self, pathToDir, recursive, column = 'dir'):
+        """ SQL matching a directory, and everything below it if recursive """
+        if not recursive:
+            return ('%s = ?' % (column), (pathToDir,))
+        # Everything under the directory sorts between these, and a range
+        # can use the index where LIKE can't.
+        prefix = os.path.join(pathToDir, '')
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return ('(%s = ? OR (%s >= ? AND %s < ?))' % ((column,) * 3),
+                (pathToDir, prefix, end))
+
+    def getGeneration(self, pathToDir, recursive = False):
+        # Recursively, the total changes whenever any directory's does.
+        match, args = self.getDirMatch(pathToDir, recursive, 'path')
+        row = self.db.execute('SELECT SUM(generation) FROM dirs WHERE ' +
+                              match, args).fetchone()
+        return row and row[0] or 0
+
+    # Images that aren't the representative of their group of near
+    # duplicates, unless that's gone.
+    duplicate = """dupgroup IS NOT NULL AND dupgroup != path AND EXISTS
+                   (SELECT 1 FROM images AS r WHERE r.path = images.dupgroup
+                    AND r.width IS NOT NULL)"""
+
+    def selectImages(self, query, args, dedup, maxPixels = 0):
+        # Leave out what's too big to decode (JPEGs can decode at down to
+        # an eighth of the size, see Desktop.limitDecode).
+        if maxPixels:
+            query += (" AND width * height <= ? * "
+                      "(CASE WHEN format = 'JPEG' THEN 64 ELSE 1 END)")
+            args = args + (maxPixels,)
+        # With dedup, leave out the duplicates of images kept elsewhere,
+        # unless they're all there is.
+        if dedup:
+            images = [r[0] for r in self.db.execute(
+                query + ' AND NOT (%s)' % (self.duplicate), args)]
+            if images:
+                return images
+        return [r[0] for r in self.db.execute(query, args)]
+
+    def getImages(self, pathToDir, recursive = False, dedup = False,
+                  maxPixels = 0):
+        """ All the usable images we know about in a directory """
+        match, args = self.getDirMatch(pathToDir, recursive)
+        return self.selectImages('SELECT path FROM images WHERE %s AND '
+                                 'width IS NOT NULL' % (match), args, dedup,
+                                 maxPixels)
+
+    def getImagesForSize(self, pathToDir, size, tolerance, preRotate,
+                         recursive = False, dedup = False, maxPixels = 0):
+        """ The images in a directory whose aspect ratio fits size """
+        # The stored dimensions are the raw pixel dimensions, which is what
+        # gets rendered (we don't apply the EXIF orientation). Portraits
+        # are turned on their side when preRotate is on, so compare
+        # them the way they will end up.
+        width, height = size
+        target = float(width) / float(height)
+        match, args = self.getDirMatch(pathToDir, recursive)
+        return self.selectImages(
+            """SELECT path FROM images
+               WHERE %s AND width IS NOT NULL AND height > 0
+               AND ABS((CASE WHEN ? AND width < height
+                        THEN CAST(height AS REAL) / width
+                        ELSE CAST(width AS REAL) / height END) / ? - 1.0)
+                   <= ?""" % (match),
+            args + (bool(preRotate), target, tolerance), dedup, maxPixels)
+
+    def getCropBox(self, pathToImage):
+        """ Fractions of the image inside its border, () if it's all border """
+        # None if we haven't looked yet.
+        row = self.db.execute('SELECT cropbox FROM images WHERE path = ?',
+                              (pathToImage,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return tuple(float(v) for v in row[0].split())
+
+    def setCropBox(self, pathToImage, box):
+        self.db.execute('UPDATE images SET cropbox = ? WHERE path = ?',
+                        (' '.join(repr(v) for v in box), pathToImage))
+        self.db.commit()
+
+    def markBroken(self, pathToImage):
+        # The header looked fine but the image didn't decode, don't pick it
+        # again until the file changes.
+        self.db.execute('UPDATE images SET width = NULL, height = NULL '
+                        'WHERE path = ?', (pathToImage,))
+        self.db.execute('UPDATE dirs SET generation = generation + 1 WHERE '
+                        'path = (SELECT dir FROM images WHERE path = ?)',
+                        (pathToImage,))
+        self.db.commit()
+
+class DirectoryCrawler(object):
+    """ Lists image directories on a pool of threads and feeds the index """
+
+    # On a network share every listing, stat and header read is a round
+    # trip, so a directory at a time mostly waits on the network. Here the
+    # file system work is spread over a pool of threads while one writer
+    # thread, with its own connection, puts each directory in the index as
+    # it's finished. So choosing a wallpaper can start on what's been found
+    # so far (see wait) while the rest comes in. A directory that takes
+    # longer than timeout is given up on for now, though whatever it finds
+    # still goes in the index if it ever turns up. With dedup, new images
+    # are hashed too and near duplicates grouped once a crawl is done.
+
+    # Headers are read in chunks this big so a large directory is spread
+    # over the threads.
+    chunkSize = 64
+
+    def __init__(self, pathToIndex, threads = 8, timeout = 60.0,
+                 recursive = False, stats = None, dedup = False,
+                 distance = 6, maxPixels = 0, budget = None):
+        self.index = ImageIndex(pathToIndex)
+        self.timeout = timeout
+        self.recursive = recursive
+        self.stats = stats or Stats(enabled = False)
+        self.dedup = dedup
+        self.distance = distance
+        # Hashing decodes too, see Desktop.limitDecode.
+        self.maxPixels = maxPixels
+        self.budget = budget
+        self.needsGrouping = dedup
+        self.pool = ThreadPool(threads)
+        self.queue = Queue.Queue()
+        # root: [directories outstanding, found any images yet]
+        self.condition = threading.Condition()
+        self.roots = {}
+        self.crawled = set()
+        # Only the writer thread uses these.
+        self.inFlight = {}
+        self.writer = threading.Thread(target = self.run)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def crawl(self, roots, force = False):
+        """ Start bringing the index up to date with some directories """
+        with self.condition:
+            for root in roots:
+                if root not in self.roots:
+                    self.roots[root] = [0, False]
+                    self.queue.put((self.submit, (root, root, force)))
+
+    def wait(self, root, partial = False):
+        """ Wait for a crawl to finish, or just to find some images """
+        with self.condition:
+            while root in self.roots:
+                if partial and self.roots[root][1]:
+                    break
+                # With a timeout so ctrl-c still works.
+                self.condition.wait(1.0)
+
+    def isCrawled(self, root):
+        return root in self.crawled
+
+    def close(self):
+        """ Let the crawls finish, then stop """
+        with self.condition:
+            while self.roots:
+                self.condition.wait(1.0)
+        # Anything we gave up on gets one more timeout to turn up.
+        self.pool.close()
+        joiner = threading.Thread(target = self.pool.join)
+        joiner.daemon = True
+        joiner.start()
+        joiner.join(self.timeout)
+        self.queue.put(None)
+        self.writer.join()
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout = min(1.0, self.timeout))
+            except Queue.Empty:
+                item = ()
+            if item is None:
+                break
+            try:
+                if item:
+                    work, args = item
+                    work(*args)
+                self.expire()
+            except Exception:
+                traceback.print_exc()
+
+    def runInPool(self, work, args, done, *doneArgs):
+        # done(*doneArgs, result) runs on the writer thread, the result is
+        # None if work failed.
+        def run():
+            try:
+                return work(*args)
+            except Exception:
+                traceback.print_exc()
+                return None
+        self.pool.apply_async(run, callback = lambda result: self.queue.put(
+            (done, doneArgs + (result,))))
+
+    def submit(self, pathToDir, root, force):
+        key = (pathToDir, root)
+        if key in self.inFlight or root not in self.roots:
+            return
+        with self.condition:
+            self.roots[root][0] += 1
+        self.inFlight[key] = time.time()
+        lastMtime, subdirs = self.index.getDirectory(pathToDir)
+        self.runInPool(ImageIndex.scanDirectory,
+                       (pathToDir, lastMtime, subdirs, force),
+                       self.listed, key, force)
+
+    def listed(self, key, force, listing):
+        pathToDir, root = key
+        if listing is None:
+            self.finish(key)
+            return
+        dirMtime, files, subdirs = listing
+        self.stats.add('dirsListed')
+        if self.recursive and key in self.inFlight:
+            for subdir in subdirs:
+                self.submit(subdir, root, force)
+        if files is None:
+            self.hash(key)
+            return
+
+        changed = ImageIndex.getChangedFiles(
+            files, self.index.getKnownFiles(pathToDir), force)
+        chunks = [changed[i:i + self.chunkSize]
+                  for i in range(0, len(changed), self.chunkSize)]
+        if not chunks:
+            self.apply(key, listing, [])
+            return
+        # listing, rows so far, chunks to come, all chunks read
+        state = [listing, [], len(chunks), True]
+        for chunk in chunks:
+            self.runInPool(ImageIndex.readHeaders, (pathToDir, chunk),
+                           self.headersRead, key, state)
+
+    def headersRead(self, key, state, rows):
+        if rows is None:
+            state[3] = False
         else:
-            width = -self.left
-            right = wallpaper.crop((0, 0, width, self.height))
-            right.load()
-            left = wallpaper.crop((width, 0, self.width, self.height))
-            left.load()
-            bgImage.paste(left, (0, self.wTop))
-            bgImage.paste(right, (bgImage.size[0] - width, self.wTop))
+            state[1].extend(rows)
+        state[2] -= 1
+        if state[2] == 0:
+            listing = state[0]
+            if not state[3]:
+                # Some files weren't read, forget the mtime so they are
+                # tried again next time.
+                listing = (None,) + listing[1:]
+            self.apply(key, listing, state[1])
+
+    def apply(self, key, listing, rows):
+        dirMtime, files, subdirs = listing
+        with self.stats.timer('crawlIndex'):
+            self.index.applyListing(key[0], dirMtime, files, rows, subdirs)
+        self.stats.add('headersRead', len(rows))
+        self.hash(key)
+
+    def hash(self, key):
+        # Includes images indexed before dedup was turned on.
+        paths = self.dedup and self.index.getUnhashed(key[0]) or []
+        if not paths:
+            self.finish(key)
+            return
+        state = [0]
+        for i in range(0, len(paths), self.chunkSize):
+            state[0] += 1
+            self.runInPool(ImageIndex.hashImages,
+                           (paths[i:i + self.chunkSize], self.maxPixels,
+                            self.budget),
+                           self.hashed, key, state)
+
+    def hashed(self, key, state, rows):
+        if rows:
+            self.index.setHashes(rows)
+            self.stats.add('imagesHashed', len(rows))
+            self.needsGrouping = True
+        state[0] -= 1
+        if state[0] == 0:
+            self.finish(key)
+
+    def groupDuplicates(self):
+        self.needsGrouping = False
+        with self.stats.timer('dedup'):
+            self.index.groupDuplicates(self.distance)
+
+    def finish(self, key):
+        pathToDir, root = key
+        if self.inFlight.pop(key, None) is None:
+            # Gave up on it already.
+            return
+        if self.roots[root][0] == 1 and self.needsGrouping:
+            # Group before the crawl counts as done, so anyone waiting for
+            # it sees the groups.
+            self.groupDuplicates()
+        found = self.roots[root][1] or self.index.hasImages(root,
+                                                            self.recursive)
+        with self.condition:
+            state = self.roots[root]
+            state[0] -= 1
+            state[1] = found
+            if state[0] == 0:
+                del self.roots[root]
+                self.crawled.add(root)
+            self.condition.notify_all()
+
+    def expire(self):
+        now = time.time()
+        for key, started in self.inFlight.items():
+            if now - started > self.timeout:
+                print >> sys.stderr, key[0], "is taking too long, skipping it"
+                self.stats.add('crawlTimeouts')
+                self.finish(key)
+
+class RotationDeck(object):
+    """ Shuffled decks of images so nothing repeats until all are seen """
+
+    # Each directory (or directory and monitor shape, with AspectMatch) has
+    # its own shuffled deck and a cursor into it, kept in the image index.
+    # Drawing is a lookup and an update in one transaction, so it survives
+    # a crash, and a deck is only dealt again when it runs out or the
+    # images in its directory change, so the history never grows.
+
+    # Decks nobody has drawn from in this long are thrown away.
+    maxIdle = 30 * 24 * 60 * 60
+
+    def __init__(self, index):
+        self.index = index
+        self.db = index.db
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS decks (
+                name TEXT PRIMARY KEY,
+                generation INTEGER,
+                cursor INTEGER,
+                length INTEGER,
+                used REAL
+            );
+            CREATE TABLE IF NOT EXISTS cards (
+                deck TEXT,
+                position INTEGER,
+                path TEXT,
+                PRIMARY KEY (deck, position)
+            );
+        """)
+        cutoff = time.time() - self.maxIdle
+        self.db.execute('DELETE FROM cards WHERE deck IN '
+                        '(SELECT name FROM decks WHERE used < ?)', (cutoff,))
+        self.db.execute('DELETE FROM decks WHERE used < ?', (cutoff,))
+        self.db.commit()
+
+    def draw(self, name, generation, getCandidates):
+        """ The next image from a deck, None if there's nothing to draw """
+        row = self.db.execute('SELECT generation, cursor, length FROM decks '
+                              'WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            self.deal(name, generation, getCandidates(), 0)
+        elif row[0] != generation:
+            # Images came or went, keep the ones already seen out of the
+            # rest of this round.
+            self.deal(name, generation, getCandidates(), row[1])
+        elif row[1] >= row[2]:
+            # Every image has been seen, start again.
+            self.deal(name, generation, getCandidates(), 0)
+
+        cursor, length = self.db.execute(
+            'SELECT cursor, length FROM decks WHERE name = ?',
+            (name,)).fetchone()
+        if cursor >= length:
+            return None
+
+        path = self.db.execute('SELECT path FROM cards WHERE deck = ? AND '
+                               'position = ?', (name, cursor)).fetchone()[0]
+        self.db.execute('UPDATE decks SET cursor = ?, used = ? WHERE name = ?',
+                        (cursor + 1, time.time(), name))
+        self.db.commit()
+        return path
+
+    def deal(self, name, generation, candidates, seenCount):
+        seen = set(r[0] for r in self.db.execute(
+            'SELECT path FROM cards WHERE deck = ? AND position < ?',
+            (name, seenCount)))
+        cards = [c for c in candidates if c not in seen] or list(candidates)
+        random.shuffle(cards)
+
+        self.db.execute('DELETE FROM cards WHERE deck = ?', (name,))
+        self.db.executemany('INSERT INTO cards VALUES (?, ?, ?)',
+                            [(name, n, c) for n, c in enumerate(cards)])
+        self.db.execute('INSERT OR REPLACE INTO decks VALUES (?, ?, ?, ?, ?)',
+                        (name, generation, 0, len(cards), time.time()))
+        self.db.commit()
+
+def getAutocontrastTable(histogram, cutoff):
+    """ The lookup table ImageOps.autocontrast uses for one band """
+    # Done the same way, so that what we call black and white borders is
+    # exactly what autoCrop found by stretching the image.
+    h = list(histogram)
+    if cutoff:
+        n = sum(h)
+        cut = n * cutoff // 100
+        for lo in range(256):
+            if cut > h[lo]:
+                cut = cut - h[lo]
+                h[lo] = 0
+            else:
+                h[lo] -= cut
+                cut = 0
+            if cut <= 0:
+                break
+        cut = n * cutoff // 100
+        for hi in range(255, -1, -1):
+            if cut > h[hi]:
+                cut = cut - h[hi]
+                h[hi] = 0
+            else:
+                h[hi] -= cut
+                cut = 0
+            if cut <= 0:
+                break
+    for lo in range(256):
+        if h[lo]:
+            break
+    for hi in range(255, -1, -1):
+        if h[hi]:
+            break
+    if hi <= lo:
+        return range(256)
+    scale = 255.0 / (hi - lo)
+    offset = -lo * scale
+    return [max(0, min(255, int(ix * scale + offset))) for ix in range(256)]
+
+def replaceFile(src, dst):
+    """ Move src over dst in one step, so dst is never half written """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    elif sys.platform == 'win32':
+        # os.rename won't overwrite on windows.
+        import win32api
+        win32api.MoveFileEx(src, dst, Win32Backend.MOVEFILE_REPLACE_EXISTING)
+    else:
+        os.rename(src, dst)
+
+def loadJson(pathToFile, default = None):
+    """ What saveJson wrote to pathToFile, default if it can't be read """
+    try:
+        f = open(pathToFile, 'rb')
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return default
+
+def saveJson(pathToFile, data, **options):
+    """ Write data out as JSON, all or nothing (see replaceFile) """
+    tmpPath = pathToFile + '.tmp'
+    f = open(tmpPath, 'wb')
+    try:
+        json.dump(data, f, **options)
+    finally:
+        f.close()
+    replaceFile(tmpPath, pathToFile)
+
+def isWritten(path, digest):
+    """ Whether path is still what saveDigest recorded as digest """
+    # The size and time catch anything else replacing the file, a
+    # prerendered wallpaper say, since we wrote it.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return loadJson(path + '.digest') == {'digest': digest,
+                                          'size': st.st_size,
+                                          'mtime': st.st_mtime}
+
+def saveDigest(path, digest):
+    """ Record what was just written to path, beside it """
+    # In a file rather than memory so one-shot runs can skip too.
+    st = os.stat(path)
+    saveJson(path + '.digest', {'digest': digest, 'size': st.st_size,
+                                'mtime': st.st_mtime})
+
+class StageTimer(object):
+    """ Times a with block as one call of a stage """
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.stats.addTime(self.name, time.time() - self.start)
+
+class NullTimer(object):
+    """ StageTimer for when nobody is looking """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+nullTimer = NullTimer()
+
+class Stats(object):
+    """ Counters and stage timings for what the wallpaper changes cost """
+
+    # Everything is a no-op until enabled, so the instrumentation can stay
+    # in the rendering code for good. The prefetch thread counts too,
+    # hence the lock. Totals are kept for the report and per-change
+    # figures for the metrics file, which gets a JSON line per change.
+
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.stages = {}
+        self.pending = {}
+        self.pendingStages = {}
+
+    def add(self, name, value = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.pending[name] = self.pending.get(name, 0) + value
+
+    def timer(self, name):
+        """ with stats.timer('decode'): ... """
+        if not self.enabled:
+            return nullTimer
+        return StageTimer(self, name)
+
+    def addTime(self, name, seconds, calls = 1, longest = None):
+        if not self.enabled:
+            return
+        if longest is None:
+            longest = seconds
+        with self.lock:
+            for stages in (self.stages, self.pendingStages):
+                stage = stages.setdefault(name, [0, 0.0, 0.0])
+                stage[0] += calls
+                stage[1] += seconds
+                stage[2] = max(stage[2], longest)
+
+    def takePending(self):
+        """ What's been counted since last time, e.g. in a worker process """
+        with self.lock:
+            pending = (self.pending, self.pendingStages)
+            self.pending = {}
+            self.pendingStages = {}
+        return pending
+
+    def merge(self, pending):
+        """ Add in what another Stats counted, from its takePending """
+        if not self.enabled or pending is None:
+            return
+        counters, stages = pending
+        for name, value in counters.items():
+            self.add(name, value)
+        for name, (calls, seconds, longest) in stages.items():
+            self.addTime(name, seconds, calls, longest)
+
+    def report(self, out = sys.stderr):
+        if not self.enabled:
+            return
+        with self.lock:
+            for name in sorted(self.counters):
+                value = self.counters[name]
+                if isinstance(value, float):
+                    print >> out, '%-24s %12.3f' % (name, value)
+                else:
+                    print >> out, '%-24s %12d' % (name, value)
+            if self.stages:
+                print >> out, '%-24s %12s %12s %12s %12s' % (
+                    'stage', 'calls', 'total (s)', 'mean (ms)', 'max (ms)')
+            for name in sorted(self.stages):
+                calls, seconds, longest = self.stages[name]
+                print >> out, '%-24s %12d %12.3f %12.1f %12.1f' % (
+                    name, calls, seconds, seconds * 1000.0 / calls,
+                    longest * 1000.0)
+
+    def writeMetrics(self, pathToMetrics, **extra):
+        """ Append a JSON line of what was counted since the last one """
+        if not self.enabled:
+            return
+        counters, stages = self.takePending()
+        record = {'time': time.time(), 'counters': counters,
+                  'stages': dict((name, {'calls': calls, 'seconds': seconds,
+                                         'max': longest})
+                                 for name, (calls, seconds, longest)
+                                 in stages.items())}
+        record.update(extra)
+        f = open(pathToMetrics, 'ab')
+        try:
+            f.write(json.dumps(record, sort_keys = True) + '\n')
+        finally:
+            f.close()
+
+class WallpaperWriter(object):
+    """ Writes the finished desktop image where Windows can pick it up """
+
+    # Written to a temporary file and moved into place so an interrupted
+    # write never leaves a half written wallpaper behind. BMP is all that
+    # older versions of Windows will take, Windows 7 and later are happy
+    # with JPEG which is a fraction of the size on a large wall.
+    extensions = {'BMP': '.bmp', 'JPEG': '.jpg', 'PNG': '.png'}
+
+    # Rows hashed at a time, see getDigest.
+    bandHeight = 64
+
+    def __init__(self, format = 'BMP', quality = 95, stats = None):
+        self.format = format.upper()
+        if self.format not in self.extensions:
+            raise Exception("Unsupported OutputFormat %s" % (format))
+        self.saveOptions = {}
+        if self.format == 'JPEG':
+            self.saveOptions['quality'] = quality
+        self.stats = stats or Stats(enabled = False)
+
+    @classmethod
+    def getFormat(cls, path, default):
+        # The format to use for a path, going by its extension.
+        ext = os.path.splitext(path)[1].lower()
+        for format, formatExt in cls.extensions.items():
+            if ext == formatExt or (format == 'JPEG' and ext == '.jpeg'):
+                return format
+        return default
+
+    def getPath(self, directory, name = 'pywallpaper'):
+        return os.path.join(directory, name + self.extensions[self.format])
+
+    def write(self, image, path, keepDigest = True):
+        """ Write image to path, False if it's already there """
+        # Hashing is a lot cheaper than writing out ~75MB for nothing.
+        # Batches have their manifest instead, and no need of a .digest
+        # for every output.
+        digest = None
+        if keepDigest:
+            digest = self.getDigest(image)
+            if isWritten(path, digest):
+                self.stats.add('writesSkipped')
+                return False
+
+        start = time.time()
+        tmpPath = path + '.tmp'
+        image.save(tmpPath, self.format, **self.saveOptions)
+        size = os.path.getsize(tmpPath)
+        replaceFile(tmpPath, path)
+        if digest is not None:
+            saveDigest(path, digest)
+
+        self.stats.add('writes')
+        self.stats.add('writeBytes', size)
+        self.stats.addTime('write', time.time() - start)
+        return True
+
+    def getDigest(self, image):
+        # A band of rows at a time, like StreamingCompositor writes, rather
+        # than a copy of the whole canvas from tobytes().
+        width, height = image.size
+        digest = hashlib.sha1(repr((image.mode, image.size)))
+        for top in range(0, height, self.bandHeight):
+            bottom = min(height, top + self.bandHeight)
+            digest.update(image.crop((0, top, width, bottom)).tobytes())
+        return digest.hexdigest()
+
+class StreamingCompositor(object):
+    """ Writes the wallpaper a band at a time from per-monitor tiles """
+
+    # For video walls where holding the whole desktop image in memory
+    # hurts. Each monitor's wallpaper goes to disk as raw RGB as soon as
+    # it's rendered, then the BMP is written bottom up (as BMPs are stored)
+    # a band of rows at a time, reading just those rows from the tiles.
+    # Peak memory is about one monitor plus a band.
+    #
+    # Tiles are named by their contents and only become the tile for their
+    # monitor when committed, so tiles rendered ahead of time can't
+    # clobber the ones on the desktop. tiles.json remembers which tiles are
+    # current between runs.
+
+    bandHeight = 64
+
+    def __init__(self, pathToTiles):
+        self.pathToTiles = pathToTiles
+        if not os.path.isdir(pathToTiles):
+            os.makedirs(pathToTiles)
+        self.pathToState = os.path.join(pathToTiles, 'tiles.json')
+        self.tiles = loadJson(self.pathToState, {})
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.removeUnused()
+
+    def getKey(self, monitor):
+        return '%d_%d_%d_%d' % tuple(monitor.physical)
+
+    def getPath(self, tile):
+        return os.path.join(self.pathToTiles, tile['file'])
+
+    def saveTile(self, monitor, wallpaper):
+        """ Write a monitor's wallpaper out, returns the tile for commit """
+        if wallpaper.mode != 'RGB':
+            wallpaper = wallpaper.convert('RGB')
+        data = wallpaper.tobytes()
+        digest = hashlib.sha1(data).hexdigest()
+        key = self.getKey(monitor)
+        tile = {'key': key, 'file': '%s-%s.rgb' % (key, digest),
+                'size': list(wallpaper.size), 'digest': digest}
+
+        with self.lock:
+            self.pending.add(tile['file'])
+        path = self.getPath(tile)
+        if not os.path.exists(path):
+            tmpPath = path + '.tmp'
+            f = open(tmpPath, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            replaceFile(tmpPath, path)
+        return tile
+
+    def commit(self, tiles):
+        """ Make these the current tiles for their monitors """
+        with self.lock:
+            for tile in tiles:
+                self.tiles[tile['key']] = tile
+                self.pending.discard(tile['file'])
+
+        saveJson(self.pathToState, self.tiles)
+        self.removeUnused()
+
+    def removeUnused(self):
+        with self.lock:
+            keep = set(t['file'] for t in self.tiles.values()) | self.pending
+        for f in os.listdir(self.pathToTiles):
+            if f.endswith('.rgb') and f not in keep:
+                try:
+                    os.remove(os.path.join(self.pathToTiles, f))
+                except OSError:
+                    pass
+
+    def write(self, pathToOutput, wallSize, background, monitors, stats):
+        """ Write a BMP of the current tiles, False if nothing changed """
+        # background is a single column, it's stretched across each band.
+        placements = []
+        for monitor in monitors:
+            tile = self.tiles.get(self.getKey(monitor))
+            if tile is None or tuple(tile['size']) != tuple(monitor.size):
+                continue
+            placements.append((tile, monitor.placements))
+
+        digest = hashlib.sha1(repr((tuple(wallSize), background.tobytes(),
+                                    [t['digest'] for t, p in placements]))
+                              ).hexdigest()
+        if isWritten(pathToOutput, digest):
+            stats.add('writesSkipped')
+            return False
+
+        start = time.time()
+        width, height = wallSize
+        stride = (width * 3 + 3) & ~3
+        tmpPath = pathToOutput + '.tmp'
+        out = open(tmpPath, 'wb')
+        tileFiles = {}
+        try:
+            out.write(struct.pack('<2sIHHI', 'BM', 54 + stride * height,
+                                  0, 0, 54))
+            # 3780 pixels a metre (96dpi) as PIL writes, so the files
+            # match byte for byte.
+            out.write(struct.pack('<IiiHHIIiiII', 40, width, height, 1, 24,
+                                  0, stride * height, 3780, 3780, 0, 0))
+            for tile, boxes in placements:
+                tileFiles[tile['file']] = open(self.getPath(tile), 'rb')
+
+            bottom = height
+            while bottom > 0:
+                top = max(0, bottom - self.bandHeight)
+                band = background.crop((0, top, 1, bottom)).resize(
+                    (width, bottom - top))
+                for tile, boxes in placements:
+                    self.pasteRows(band, top, bottom, tile,
+                                   tileFiles[tile['file']], boxes)
+                out.write(band.tobytes('raw', 'BGR', stride, -1))
+                bottom = top
+        finally:
+            out.close()
+            for f in tileFiles.values():
+                f.close()
+
+        size = os.path.getsize(tmpPath)
+        replaceFile(tmpPath, pathToOutput)
+        saveDigest(pathToOutput, digest)
+        stats.add('writes')
+        stats.add('writeBytes', size)
+        stats.addTime('write', time.time() - start)
+        return True
+
+    def pasteRows(self, band, top, bottom, tile, f, boxes):
+        # Paste the rows of a tile that fall within the band.
+        tileWidth = tile['size'][0]
+        for (left, boxTop, right, boxBottom), (x, y) in boxes:
+            first = max(top, y)
+            last = min(bottom, y + boxBottom - boxTop)
+            if first >= last:
+                continue
+            f.seek((boxTop + first - y) * tileWidth * 3)
+            rows = Image.frombytes('RGB', (tileWidth, last - first),
+                                   f.read((last - first) * tileWidth * 3))
+            if left or right != tileWidth:
+                rows = rows.crop((left, 0, right, last - first))
+            band.paste(rows, (x, first - top))
+
+class RenderCache(object):
+    """ Size bounded on-disk cache of rendered monitor wallpapers """
+
+    # Entries are keyed on everything that changes the rendered pixels, so
+    # a stale entry can never be returned, it just ages out. Every hit
+    # touches the file so the oldest mtime is the least recently used.
+    #
+    # RAW entries are a header and then the pixels laid out exactly as PIL
+    # holds an RGB image in memory, 4 bytes a pixel. A hit maps the file
+    # and wraps an image round it, nothing is decoded or copied until it's
+    # pasted, and then it's just a copy out of the page cache.
+
+    rawHeader = struct.Struct('<4sIII')
+    rawMagic = 'PWR1'
+
+    def __init__(self, pathToCache, maxBytes, format = 'PNG'):
+        self.pathToCache = pathToCache
+        self.maxBytes = maxBytes
+        self.format = format.upper()
+        self.totalBytes = None
+        if not os.path.isdir(pathToCache):
+            os.makedirs(pathToCache)
+
+    def makeKey(self, pathToImage, size, settings):
+        st = os.stat(pathToImage)
+        key = repr((os.path.abspath(pathToImage), st.st_mtime, st.st_size,
+                    tuple(size), sorted(settings.items())))
+        return hashlib.sha1(key).hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.pathToCache,
+                            key + (self.format == 'RAW' and '.raw' or '.png'))
+
+    def get(self, key):
+        path = self.getPath(key)
+        try:
+            if self.format == 'RAW':
+                image = self.mapRaw(path)
+            else:
+                image = Image.open(path)
+                image.load()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return image
+
+    def mapRaw(self, path):
+        f = open(path, 'rb')
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, width, height, reserved = self.rawHeader.unpack(
+            mapped[:self.rawHeader.size])
+        if (magic != self.rawMagic or
+            len(mapped) != self.rawHeader.size + width * height * 4):
+            raise ValueError("Bad cache entry %s" % (path))
+        # Image.frombuffer only maps modes whose bytes are already laid out
+        # the way PIL keeps them, which is true of ours but RGB isn't on its
+        # list. The image keeps the mapping open for as long as it lives.
+        image = Image.new('RGB', (1, 1))._new(Image.core.map_buffer(
+            mapped, (width, height), 'raw', None, self.rawHeader.size,
+            ('RGB', 0, 1)))
+        image.readonly = 1
+        return image
+
+    def saveRaw(self, image, path):
+        f = open(path, 'wb')
+        try:
+            f.write(self.rawHeader.pack(self.rawMagic, image.size[0],
+                                        image.size[1], 0))
+            f.write(image.convert('RGB').tobytes('raw', 'RGBX'))
+        finally:
+            f.close()
+
+    def put(self, key, image):
+        path = self.getPath(key)
+        tmpPath = path + '.tmp'
+        try:
+            if self.format == 'RAW':
+                self.saveRaw(image, tmpPath)
+            else:
+                # Speed matters more than size here.
+                image.save(tmpPath, 'PNG', compress_level = 1)
+            replaceFile(tmpPath, path)
+        except (IOError, OSError):
+            # A full disk shouldn't stop the wallpaper changing, nor on
+            # windows can we replace an entry that's mapped.
+            return
 
-            
-    def getSize(self, left, top, right, bottom):
-        return [abs(right - left), abs(bottom - top)]
+        if self.totalBytes is None:
+            self.totalBytes = sum(size for mtime, size, path in self.entries())
+        else:
+            self.totalBytes += os.path.getsize(path)
 
-    def __repr__(self):
-        return 'extent: ' + str(self.physical) + ' :: size: ' + str(self.size) + ' :: primary: ' + str(self.isPrimary) + ' :: needsSplit ' + str(self.needsSplit) + ':: ' + hex(self.monitor)
-    def __cmp__(self, other):
-        if not cmp(self.cTop, other.cTop):
-            return cmp(self.cLeft, other.cLeft)
-        return cmp(self.top, other.top)
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+
+    def entries(self):
+        retval = []
+        for f in os.listdir(self.pathToCache):
+            path = os.path.join(self.pathToCache, f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            retval.append((st.st_mtime, st.st_size, path))
+        return retval
+
+    def evict(self):
+        entries = self.entries()
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.totalBytes = total
+
+class MemoryBudget(object):
+    """ Bytes of image decoding going on at once, across processes """
+
+    # Counting decodes doesn't bound memory, one 100MP image costs as much
+    # as fifty small ones. Each decode takes its estimated bytes from the
+    # budget and waits while everybody else's would put it over. One
+    # decode always goes ahead however big it is, so nothing waits forever.
+    # Handed to the render processes when they start.
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.condition = multiprocessing.Condition()
+        self.used = multiprocessing.RawValue('d', 0.0)
+
+    def acquire(self, nbytes):
+        """ Take nbytes of the budget, True if we had to wait for it """
+        waited = False
+        with self.condition:
+            while (self.used.value > 0 and
+                   self.used.value + nbytes > self.maxBytes):
+                waited = True
+                self.condition.wait()
+            self.used.value += nbytes
+        return waited
+
+    def release(self, nbytes):
+        with self.condition:
+            self.used.value -= nbytes
+            self.condition.notify_all()
+
+class Scheduler(object):
+    """ A select() loop of timers, background work and a control socket """
+
+    # Python 2 has no asyncio, but this is all the daemon needs: timers
+    # kept in a heap, blocking work (PIL, listing network shares) done on
+    # a worker thread with its result handed back to the loop, and
+    # commands over a localhost socket. With nothing to do the loop just
+    # waits in select() for the next timer.
 
-class Desktop(object):
     def __init__(self):
-        self.setMonitorExtents()
+        self.timers = []
+        self.sequence = 0
+        self.executor = ThreadPool(1)
+        self.done = Queue.Queue()
+        self.pending = 0
+        self.listener = None
+        self.handler = None
+        self.clients = {}
+        self.running = False
+
+    def callAt(self, when, callback, *args):
+        """ Call callback(*args) on the loop at time when """
+        self.sequence += 1
+        timer = [when, self.sequence, callback, args, True]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def callLater(self, delay, callback, *args):
+        return self.callAt(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer is not None:
+            timer[4] = False
+
+    def submit(self, work, done, *args):
+        """ Run work(*args) on the worker thread, then done(result) here """
+        # done gets None if work raised.
+        def run():
+            try:
+                return work(*args)
+            except Exception:
+                traceback.print_exc()
+                return None
+        self.pending += 1
+        self.executor.apply_async(run, callback = lambda result:
+                                  self.done.put((done, result)))
+
+    def listen(self, port, handler):
+        """ Answer commands on localhost:port, handler(line) gives the reply """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(5)
+        self.listener.setblocking(0)
+        self.handler = handler
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                self.runTimers()
+                self.runDone()
+                self.wait(self.getTimeout())
+        finally:
+            if self.listener is not None:
+                self.listener.close()
+            self.executor.terminate()
+
+    def runTimers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now and self.running:
+            when, sequence, callback, args, active = heapq.heappop(self.timers)
+            if active:
+                callback(*args)
+
+    def runDone(self):
+        while True:
+            try:
+                done, result = self.done.get_nowait()
+            except Queue.Empty:
+                return
+            self.pending -= 1
+            done(result)
+
+    def getTimeout(self):
+        while self.timers and not self.timers[0][4]:
+            heapq.heappop(self.timers)
+        timeout = 3600.0
+        if self.timers:
+            timeout = max(0.0, self.timers[0][0] - time.time())
+        if self.pending:
+            # Background work finishing doesn't wake select() up.
+            timeout = min(timeout, 0.05)
+        if sys.platform == 'win32':
+            # Nor does ctrl-c on windows.
+            timeout = min(timeout, 1.0)
+        return timeout
+
+    def wait(self, timeout):
+        sockets = self.clients.keys()
+        if self.listener is not None:
+            sockets.append(self.listener)
+        if not sockets:
+            # select() on windows won't wait on nothing.
+            time.sleep(timeout)
+            return
+        readable, writable, errors = select.select(sockets, [], [], timeout)
+        for sock in readable:
+            if sock is self.listener:
+                self.accept()
+            else:
+                self.readCommand(sock)
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.clients[sock] = ''
+
+    def readCommand(self, sock):
+        # One line in, the reply out, then hang up.
+        try:
+            data = sock.recv(4096)
+        except socket.error:
+            data = ''
+        if data:
+            self.clients[sock] += data
+            if '\n' not in self.clients[sock] and len(self.clients[sock]) < 4096:
+                return
+        line = self.clients.pop(sock).split('\n')[0].strip()
+        try:
+            if line:
+                try:
+                    reply = self.handler(line)
+                except Exception:
+                    traceback.print_exc()
+                    reply = 'error'
+                sock.setblocking(1)
+                sock.sendall(reply.rstrip('\n') + '\n')
+        except socket.error:
+            pass
+        sock.close()
+
+class WallpaperDaemon(object):
+    """ Timed mode: every monitor changes on its own timer """
+
+    # Each monitor's next Prefetch wallpapers are rendered in the background
+    # and kept ready (unless Prefetch is 0), so changing it is
+    # just writing the wallpaper out, which is done in the background too,
+    # as is checking the monitors. Monitors due within a second of each
+    # other change together. Monitors are tracked by their rectangle so
+    # docking and undocking (see Desktop.updateTopology) only affects the
+    # monitors that come and go. The config is re-read when it changes
+    # and directories are rescanned in the background.
+
+    # Monitors due this close together change together.
+    window = 1.0
+
+    def __init__(self, desktop, options):
+        self.desktop = desktop
+        self.options = options
+        self.defaultInterval = options.change_time * 60.0
+        self.scheduler = Scheduler()
+        self.paused = False
+        self.due = {}
+        self.changed = {}
+        self.timers = {}
+        self.ready = {}
+        self.rendering = set()
+        self.waiting = set()
+        self.rescans = {}
+        self.checkingTopology = False
+        # Bumped when the config changes what gets rendered, renders
+        # started before then are thrown away.
+        self.generation = 0
+        self.configMtime = self.getConfigMtime()
+
+    def run(self):
+        d = self.desktop
+        if d.ControlPort:
+            self.scheduler.listen(d.ControlPort, self.command)
+        if d.TopologyPoll > 0:
+            self.scheduler.callLater(d.TopologyPoll, self.checkTopology)
+        if d.ConfigPoll > 0:
+            self.scheduler.callLater(d.ConfigPoll, self.checkConfig)
+        self.scheduleRescans()
+        self.changeNow([m.key for m in d.monitors])
+        try:
+            self.scheduler.run()
+        finally:
+            if d.pool is not None:
+                d.pool.terminate()
+
+    def getMonitorNumbers(self, keys):
+        return [n for n, m in enumerate(self.desktop.monitors) if m.key in keys]
+
+    def getInterval(self, key):
+        for n in self.getMonitorNumbers([key]):
+            return self.desktop.getMonitorInterval(n, self.defaultInterval)
+        return self.defaultInterval
+
+    def schedule(self, key, when):
+        self.scheduler.cancel(self.timers.get(key))
+        self.due[key] = when
+        self.timers[key] = self.scheduler.callAt(when, self.monitorDue, key)
+
+    def monitorDue(self, key):
+        if self.desktop.TopologyPoll <= 0:
+            self.refreshTopology()
+        # Bring in anyone else due about now so they share a write.
+        now = time.time()
+        keys = [k for k, when in self.due.items() if when - now < self.window]
+        self.changeNow(keys)
+
+    def changeNow(self, keys):
+        for key in keys:
+            self.scheduler.cancel(self.timers.pop(key, None))
+            self.due.pop(key, None)
+            self.waiting.add(key)
+        self.prepare([k for k in keys
+                      if not self.ready.get(k) and k not in self.rendering])
+        self.applyWaiting()
+
+    def prepare(self, keys):
+        """ Render the next wallpaper for these monitors in the background """
+        if not keys:
+            return
+        self.rendering.update(keys)
+        generation = self.generation
+        self.scheduler.submit(self.desktop.renderFrame,
+                              lambda frame: self.prepared(keys, frame,
+                                                          generation),
+                              self.getMonitorNumbers(keys))
+
+    def prepared(self, keys, frame, generation):
+        # The frame is a list of (monitor, wallpaper), monitors that failed
+        # to render aren't in it.
+        if generation != self.generation:
+            return
+        self.rendering.difference_update(keys)
+        rendered = []
+        for monitor, img in frame or []:
+            if monitor.key in keys:
+                self.ready.setdefault(monitor.key, []).append((monitor, img))
+                rendered.append(monitor.key)
+        for key in keys:
+            if not self.ready.get(key) and key in self.waiting:
+                # Try again next time rather than straight away.
+                self.waiting.discard(key)
+                self.schedule(key, time.time() + self.getInterval(key))
+        self.applyWaiting()
+        # Carry on filling the queues that are filling, not ones that fail.
+        self.prefetch(rendered)
+
+    def applyWaiting(self):
+        if self.paused:
+            return
+        keys = [k for k in self.waiting if self.ready.get(k)]
+        if not keys:
+            return
+        # Queued on the worker, so it goes up before the next render.
+        self.scheduler.submit(self.desktop.applyFrame, self.written,
+                              [self.ready[k].pop(0) for k in keys])
+        now = time.time()
+        for key in keys:
+            self.waiting.discard(key)
+            self.changed[key] = now
+            self.schedule(key, now + self.getInterval(key))
+        self.prefetch(keys)
+
+    def prefetch(self, keys):
+        # Top up the queues of rendered wallpapers to Prefetch deep, one
+        # render per monitor at a time.
+        self.prepare([k for k in keys if k not in self.rendering and
+                      len(self.ready.get(k, ())) < self.desktop.Prefetch])
+
+    def written(self, result):
+        # Nothing to do once it's up, failures have been printed already.
+        pass
+
+    def checkTopology(self):
+        self.scheduler.callLater(self.desktop.TopologyPoll, self.checkTopology)
+        self.refreshTopology()
+
+    def refreshTopology(self):
+        # Re-reading the monitors waits for any render, so it's done on the
+        # worker. Don't queue up another while one is waiting.
+        if self.checkingTopology:
+            return
+        self.checkingTopology = True
+        self.scheduler.submit(self.desktop.updateTopology, self.updateMonitors)
+
+    def updateMonitors(self, changed):
+        self.checkingTopology = False
+        d = self.desktop
+        if changed is None:
+            return
+        print >> sys.stderr, "Monitors changed, %d now" % len(d.monitors)
+        keys = set(m.key for m in d.monitors)
+        for key in list(self.due) + list(self.ready) + list(self.waiting):
+            if key not in keys:
+                self.scheduler.cancel(self.timers.pop(key, None))
+                self.due.pop(key, None)
+                self.changed.pop(key, None)
+                self.ready.pop(key, None)
+                self.waiting.discard(key)
+        # Show the new layout straight away, new monitors are painted when
+        # they've rendered.
+        self.scheduler.submit(d.setWallpaper, self.written)
+        self.changeNow([d.monitors[n].key for n in changed])
+
+    def getConfigMtime(self):
+        try:
+            return os.stat(self.desktop.configFile).st_mtime
+        except OSError:
+            return None
+
+    def checkConfig(self):
+        self.scheduler.callLater(self.desktop.ConfigPoll, self.checkConfig)
+        mtime = self.getConfigMtime()
+        if mtime != self.configMtime and mtime is not None:
+            self.configMtime = mtime
+            self.reload()
+
+    def reload(self):
+        # On the worker thread so the pool isn't restarted mid render.
+        self.scheduler.submit(self.desktop.reloadConfig, self.reloaded,
+                              self.options)
+
+    def reloaded(self, changed):
+        if changed is None:
+            print >> sys.stderr, "Couldn't reload", self.desktop.configFile
+            return
+        print >> sys.stderr, "Reloaded", self.desktop.configFile
+        now = time.time()
+        for key in self.due.keys():
+            # New intervals count from the last change.
+            last = self.changed.get(key, now)
+            self.schedule(key, max(now, last + self.getInterval(key)))
+        self.scheduleRescans()
+        if changed:
+            # Rendering changed, anything rendered already is stale.
+            self.generation += 1
+            self.ready.clear()
+            self.rendering.clear()
+            self.desktop.createEmptyWallpaper()
+            self.desktop.restartRenderPool()
+            self.changeNow([m.key for m in self.desktop.monitors])
+
+    def scheduleRescans(self):
+        # Each directory on its own timer, spread out over the interval.
+        for timer in self.rescans.values():
+            self.scheduler.cancel(timer)
+        self.rescans = {}
+        interval = self.desktop.RescanInterval * 60.0
+        if interval <= 0:
+            return
+        dirs = sorted(set(self.desktop.getAllImageDirectories()))
+        for n, pathToDir in enumerate(dirs):
+            self.rescans[pathToDir] = self.scheduler.callLater(
+                interval * (n + 1) / len(dirs), self.rescan, pathToDir)
+
+    def rescan(self, pathToDir):
+        interval = self.desktop.RescanInterval * 60.0
+        self.rescans[pathToDir] = self.scheduler.callLater(
+            interval, self.rescan, pathToDir)
+        self.desktop.rescanDirectory(pathToDir)
+
+    def command(self, line):
+        """ Handle a control socket command, returns the reply """
+        words = line.split()
+        name, args = words[0].lower(), words[1:]
+        d = self.desktop
+        if name == 'next':
+            keys = [m.key for m in d.monitors]
+            if args:
+                keys = [d.monitors[int(n)].key for n in args
+                        if 0 <= int(n) < len(d.monitors)]
+            self.changeNow(keys)
+            return 'changing %d monitors' % len(keys)
+        if name == 'pause':
+            self.paused = True
+            return 'paused'
+        if name == 'resume':
+            self.paused = False
+            self.applyWaiting()
+            return 'resumed'
+        if name == 'stats':
+            out = StringIO.StringIO()
+            d.stats.report(out)
+            return out.getvalue() or 'no stats'
+        if name == 'status':
+            now = time.time()
+            lines = [self.paused and 'paused' or 'running']
+            for n, m in enumerate(d.monitors):
+                when = self.due.get(m.key)
+                lines.append('monitor %d %dx%d %s, %d ready' % (
+                    n, m.size[0], m.size[1],
+                    when is None and 'changing' or
+                    'next in %ds' % max(0, when - now),
+                    len(self.ready.get(m.key, ()))))
+            return '\n'.join(lines)
+        if name == 'reload':
+            self.reload()
+            return 'reloading'
+        if name == 'quit':
+            self.scheduler.stop()
+            return 'bye'
+        return 'unknown command %s (next [n...], pause, resume, stats, ' \
+               'status, reload, quit)' % name
+
+# Process pool rendering. Each worker process gets its own render-only
+# Desktop and hands back raw pixels, which are much cheaper to send back
+# to us than a pickled Image.
+renderer = None
+
+def initRenderWorker(settings, cacheDir, cacheSize, profile = False,
+                     pathToIndex = None, cacheFormat = 'PNG', budget = None):
+    global renderer
+    renderer = Desktop.forRendering(settings, cacheDir, cacheSize,
+                                    cacheFormat = cacheFormat,
+                                    budget = budget)
+    renderer.stats.enabled = profile
+    if pathToIndex:
+        # For the crop boxes.
+        renderer.index = ImageIndex(pathToIndex)
+
+def renderWorker(pathToImage, monitor):
+    # Returns the image, what rendering it cost for the parent's Stats and
+    # whether the image wouldn't decode.
+    try:
+        img = renderer.createWallPaperFromFile(pathToImage, monitor)
+    except Exception, e:
+        traceback.print_exc()
+        return (None, renderer.stats.takePending(),
+                isDecodeError(e))
+    return ((img.mode, img.size, img.tobytes()), renderer.stats.takePending(),
+            False)
+
+def imageFromBuffer(buf):
+    if buf is None:
+        return None
+    mode, size, data = buf
+    return Image.frombytes(mode, size, data)
+
+# Batch rendering. Each worker keeps a Desktop per layout and writes the
+# finished wallpapers out itself so only paths come back to us.
+batchSettings = None
+batchDesktops = {}
+
+def initBatchWorker(settings, cacheDir, cacheSize, cacheFormat = 'PNG',
+                    budget = None):
+    global batchSettings
+    batchSettings = (settings, cacheDir, cacheSize, cacheFormat, budget)
+
+def batchWorker(task):
+    pathToImage, pathToLayout, pathToOutput = task[:3]
+    try:
+        d = batchDesktops.get(pathToLayout)
+        if d is None:
+            settings, cacheDir, cacheSize, cacheFormat, budget = batchSettings
+            d = Desktop.forRendering(settings, cacheDir, cacheSize,
+                                     HeadlessBackend.fromFile(pathToLayout),
+                                     cacheFormat, budget)
+            d.setMonitorExtents()
+            batchDesktops[pathToLayout] = d
+
+        start = time.time()
+        d.createEmptyWallpaper()
+        for monitor, img in d.renderImageFrame(pathToImage):
+            monitor.addWallpaper(d.bgImage, img)
+        d.writer.write(d.bgImage, pathToOutput, keepDigest = False)
+        return (task, time.time() - start, None)
+    except Exception:
+        return (task, 0, traceback.format_exc())
+
+class Desktop(object):
+    # Everything that changes what createWallPaperFromFile renders, these
+    # make up part of the render cache key.
+    renderSettings = ('Blending', 'BlendRatio', 'bgColour', 'Crop', 'Fill',
+                      'PreRotate', 'FastLoad', 'FusedRender', 'MaxPixels')
+
+    def __init__(self, backend = None):
+        # Where the monitors come from and the wallpaper goes, chosen in
+        # go() if not given.
+        self.backend = backend
+        self.layout = None
+        self.monitors = ()
+        self.wSize = None
 
         # Merge with the desktop background colour
         # Handy to tint your background to your theme.
@@ -207,8 +2393,113 @@ class Desktop(object):
         # With per-monitor dirs you can sort your pictures based on aspect
         # ratio if you want.
         self.PreRotate = True
-        
-        self.createEmptyWallpaper()
+
+        # Blank (or gradient) canvas the monitor wallpapers are pasted on,
+        # see createEmptyWallpaper.
+        self.emptyWallpaper = None
+        self.emptyWallpaperKey = None
+
+        # Have the decoder hand us the image at the smallest reduced size
+        # that is still big enough for the monitor, rather than decoding
+        # every pixel of a 24MP photo just to shrink it again.
+        self.FastLoad = True
+
+        # Images over MaxPixels megapixels, going by their headers, are
+        # decoded at a reduced size if the format can do that (JPEG) and
+        # skipped if not. Renders also wait for a share of DecodeMemory
+        # megabytes, shared by the render processes, so several huge images
+        # aren't decoded at once.
+        self.MaxPixels = 100.0
+        self.DecodeMemory = 1024
+        self.decodeBudget = None
+
+        # Scale, centre and tint each wallpaper in one go (fitToMonitor)
+        # rather than through full size intermediate images.
+        self.FusedRender = True
+
+        # Prefer images whose aspect ratio is within AspectTolerance of the
+        # monitor's so less gets cropped or letterboxed, falls back to the
+        # whole directory if nothing fits.
+        self.AspectMatch = False
+        self.AspectTolerance = 0.15
+
+        # Where we keep the image index, relative to the working directory.
+        self.IndexFile = 'pywallpaper.db'
+        self.index = None
+        self.deck = None
+
+        # Keep rendered wallpapers so an image that comes round again on a
+        # monitor of the same size is just loaded. Size is in megabytes.
+        self.RenderCache = True
+        self.RenderCacheDir = 'pywallpaper_cache'
+        self.RenderCacheSize = 512
+        # PNG, or RAW for entries that are mapped rather than decoded.
+        self.RenderCacheFormat = 'PNG'
+        self.cache = None
+
+        # Wallpapers rendered ahead for each monitor in timed mode, topped
+        # up as each one goes up. 0 renders each one when it is due.
+        self.Prefetch = 1
+
+        # Seconds between checks for monitors changing in timed mode, 0
+        # only checks when the wallpaper changes.
+        self.TopologyPoll = 5.0
+        self.fingerprint = None
+        self.renderLock = threading.Lock()
+
+        # Seconds between checks for the config file changing, and minutes
+        # between rescans of each image directory, in timed mode. 0 turns
+        # either off.
+        self.ConfigPoll = 5.0
+        self.RescanInterval = 10.0
+        self.configFile = None
+
+        # List the image directories (and their subdirectories if
+        # Recursive) on this many threads, giving up on any directory that
+        # takes longer than CrawlTimeout seconds for now.
+        self.Recursive = False
+        self.CrawlThreads = 8
+        self.CrawlTimeout = 60.0
+        self.crawler = None
+
+        # Hash each image when it's indexed and only rotate through the
+        # biggest of each group of near duplicates, those within
+        # DedupDistance bits of each other.
+        self.Dedup = False
+        self.DedupDistance = 6
+
+        # Localhost port timed mode takes commands on (see --send), 0 is
+        # off.
+        self.ControlPort = 0
+
+        # Render each monitor's wallpaper in a pool of this many processes,
+        # 0 renders them one after the other in this process.
+        self.RenderProcesses = 0
+        self.pool = None
+
+        # After a one-shot run puts its wallpaper up it renders the next
+        # one, which the next run (at the next logon, say) just moves into
+        # place as long as nothing it was rendered for has changed.
+        self.PrerenderNext = False
+
+        # Format the finished wallpaper is written in, BMP works everywhere
+        # but JPEG (Windows 7 and later) is much less to write.
+        self.OutputFormat = 'BMP'
+        self.OutputQuality = 95
+        self.writer = None
+        self.outputPath = None
+
+        # Off unless asked for with --stats or a MetricsFile.
+        self.stats = Stats(enabled = False)
+        self.reportStats = False
+        self.MetricsFile = None
+
+        # Write the wallpaper a band at a time from per-monitor tiles on
+        # disk instead of building it in memory, for very large desktops.
+        # Only works with BMP output.
+        self.Streaming = False
+        self.TileDir = 'pywallpaper_tiles'
+        self.compositor = None
 
     def createEmptyWallpaper(self):
         c = (0, 0, 0)
@@ -217,148 +2508,206 @@ class Desktop(object):
             # Alpha blend the image with the current desktop colour
             # Or black if something goes wrong with getting the desktop colour
             try:
-                dc = windll.user32.GetSysColor(1)
-                c = ((dc & 0xFF  ),
-                     (dc & 0xFF00) >> 8,
-                     (dc & 0xFF0000) >> 16)
+                c = self.backend.getDesktopColour()
             except:
                 pass
 
         self.bgColour = c
 
-        bgImage = Image.new('RGB', self.wSize, c)
-            
-        if self.Gradient:
-            r, g, b = c
-            width, height = bgImage.size
-            fh = float(height)
-
-            if (r + g + b) / 3 < 64:
-                r1, g1, b1 = (128, 128, 128)
-            else:
-                r1, g1, b1 = c
-                r, g, b = (64, 64, 64)
-
-            rd = r1 - r
-            gd = g1 - g
-            bd = b1 - b
-
-            rs = float(rd) / fh
-            gs = float(gd) / fh
-            bs = float(bd) / fh
-
-            draw = ImageDraw.Draw(bgImage)
-            for h in range(0, height):
-                draw.line((0, h, width, h),
-                          fill = (int(r1), int(g1), int(b1)))
-                r1 -= rs
-                b1 -= bs
-                g1 -= gs
-                
-        self.bgImage = bgImage
-
-    def findMonitors(self):
-        retval = []
-        CBFUNC = ctypes.WINFUNCTYPE(ctypes.c_int, ctypes.c_ulong, ctypes.c_ulong, ctypes.POINTER(RECT), ctypes.c_double)
-        def cb(hMonitor, hdcMonitor, lprcMonitor, dwData):
-            r = lprcMonitor.contents
-            data = [hMonitor]
-            data.append(r.dump())
-            retval.append(data)
-            return 1
-        cbfunc = CBFUNC(cb)
-        temp = windll.user32.EnumDisplayMonitors(0, 0, cbfunc, 0)
-        return retval
-
-    def calcWallSize(self):
-        # Also sets the relative offsets for building the wallpaper...
-        
-        ms = self.monitors
-
-        primaryMonitor = [m for m in ms if m.isPrimary][0]
-
-        leftMonitors = [m for m in ms if m.left < 0]
-        rightMonitors = [m for m in ms if m.left >= primaryMonitor.right]
-        topMonitors = [m for m in ms if m.top < 0]
-        bottomMonitors = [m for m in ms if m.top >= primaryMonitor.bottom]
-
-        leftMonitors.sort()
-        rightMonitors.sort()
-        topMonitors.sort()
-        bottomMonitors.sort()
-
-        hMonitors = [primaryMonitor,] + rightMonitors + leftMonitors
-        vMonitors = [primaryMonitor,] + bottomMonitors + topMonitors
-
-        width = max([m.right for m in ms])
-        height = max([m.bottom for m in ms])
-
-        extraWidth = -min([m.left for m in ms])
-        extraHeight = -min([m.top for m in ms])
-
-        width += extraWidth
-        height += extraHeight
-
-        hOff = width
-        redo = []
-        for m in leftMonitors:
-            m.wLeft = width + m.left
-            if m in bottomMonitors:
-                continue
-            m.right = width
-
-        for m in topMonitors:
-            m.wTop = height + m.top
-            if m in rightMonitors:
-                continue
-
-            m.bottom = height
+        if self.compositor is not None:
+            # Never holds the whole desktop, see getBackgroundColumn.
+            self.bgImage = None
+            return
 
-        return (width, height)    
+        # The blank canvas only depends on these so build it once and hand
+        # out copies, the gradient in particular isn't free on a big wall.
+        key = (tuple(self.wSize), c, self.Gradient)
+        if key != self.emptyWallpaperKey:
+            self.emptyWallpaper = self.renderEmptyWallpaper(self.wSize, c,
+                                                            self.Gradient)
+            self.emptyWallpaperKey = key
+
+        self.bgImage = self.emptyWallpaper.copy()
+
+    def getBackgroundColumn(self):
+        # One column of the background, for StreamingCompositor.
+        return self.renderEmptyWallpaper((1, self.wSize[1]), self.bgColour,
+                                         self.Gradient)
+
+    def getGradientColours(self, c):
+        # Top and bottom colours of the gradient.
+        r, g, b = c
+        if (r + g + b) / 3 < 64:
+            return ((128, 128, 128), c)
+        return (c, (64, 64, 64))
+
+    def renderEmptyWallpaper(self, size, c, gradient):
+        if not gradient:
+            return Image.new('RGB', size, c)
+
+        top, bottom = self.getGradientColours(c)
+        width, height = size
+        fh = float(height)
+
+        # Work out one column of the gradient and stretch it across the
+        # desktop rather than drawing it a line at a time.
+        column = Image.new('RGB', (1, height))
+        column.putdata([tuple(int(t + (b - t) * h / fh)
+                              for t, b in zip(top, bottom))
+                        for h in xrange(height)])
+        return column.resize(size, Image.NEAREST)
 
     def getMonitors(self):
-        retval = []
-        for hMonitor, extents in self.findMonitors():
-            # data = [hMonitor]
-            mi = MONITORINFO()
-            mi.cbSize = ctypes.sizeof(MONITORINFO)
-            mi.rcMonitor = RECT()
-            mi.rcWork = RECT()            
-            res = windll.user32.GetMonitorInfoA(hMonitor, ctypes.byref(mi))
-            data = Monitor(hMonitor, mi.rcMonitor.dump(), mi.rcWork.dump(), mi.dwFlags)
-            retval.append(data)
-        return retval
-        
+        return self.backend.getMonitors()
+
     def setMonitorExtents(self):
-        self.monitors = self.getMonitors()
-        self.wSize = self.calcWallSize()
+        # Fingerprint first so a change while we enumerate is seen next time.
+        self.fingerprint = self.backend.getFingerprint()
+        self.layout = Layout(self.getMonitors())
+        self.monitors = self.layout.monitors
+        self.wSize = self.layout.size
+
+    def updateTopology(self):
+        """ Re-read the monitors if they've changed, returns new monitor numbers """
+        # None when nothing changed. Checking the fingerprint is cheap,
+        # enumerating the monitors and rebuilding the canvas isn't, so only
+        # do that when it changes. Monitors that are still there keep their
+        # wallpaper, only the new ones need rendering.
+        if self.backend.getFingerprint() == self.fingerprint:
+            return None
+
+        oldMonitors = dict((m.key, m) for m in self.monitors)
+        oldImage = self.bgImage
+        with self.renderLock:
+            self.setMonitorExtents()
+            self.createEmptyWallpaper()
+
+        changed = []
+        for n, monitor in enumerate(self.monitors):
+            old = oldMonitors.get(monitor.key)
+            if old is None:
+                changed.append(n)
+            elif oldImage is not None:
+                # It may have moved on the desktop image even so.
+                monitor.addWallpaper(self.bgImage, old.getWallpaper(oldImage))
+        self.stats.add('topologyChanges')
+        return changed
 
     def getDefaultDirs(self):
         return [r'C:\Documents and Settings\All Users\Documents\My Pictures\Sample Pictures',]
 
     def setWallPaperFromBmp(self, pathToBmp):
         """ Given a path to a bmp, set it as the wallpaper """
-
-        # Set it and make sure windows remembers the wallpaper we set.
-        result = windll.user32.SystemParametersInfoA(
-            SPI_SETDESKWALLPAPER, 0,
-            pathToBmp,
-            SPIF_UPDATEINIFILE | SPIF_SENDWININICHANGE)
-        
-        if not result:
-            raise Exception("Unable to set wallpaper.")
-
-    def autoCrop(self, im, bgcolor = (0, 0, 0)):
-        if im.mode != "RGB":
-            im = im.convert("RGB")
-
-        im2 = ImageOps.autocontrast(im, 5)
-        bg = Image.new("RGB", im.size, bgcolor)
-        diff = ImageChops.difference(im2, bg)
-        bbox = diff.getbbox()
-        if bbox:
-            return im.crop(bbox)
-        return im # no contents
+        self.backend.setWallpaper(pathToBmp)
+
+    def cropBorders(self, image, pathToImage = None):
+        """ Crop off black and white borders, remembering where they were """
+        # Does the job of autoCrop black then white, without three full
+        # size copies of the image. The box is kept in the index as
+        # fractions of the image so it holds at any FastLoad scale.
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        box = self.getCropBox(image, pathToImage)
+        if box is None:
+            return image # no contents
+        return image.crop(box)
+
+    def getCropBox(self, image, pathToImage = None):
+        """ The box for cropBorders to crop to, None if there's no border """
+        width, height = image.size
+        box = None
+        if self.index is not None and pathToImage is not None:
+            box = self.index.getCropBox(pathToImage)
+            self.stats.add(box is None and 'cropMisses' or 'cropHits')
+        if box is None:
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            found = self.findContentBox(image)
+            box = ()
+            if found:
+                box = (found[0] / float(width), found[1] / float(height),
+                       found[2] / float(width), found[3] / float(height))
+            if self.index is not None and pathToImage is not None:
+                self.index.setCropBox(pathToImage, box)
+
+        if not box:
+            return None
+        # Round outwards, a sliver of border beats losing picture.
+        left, top = int(box[0] * width + 1e-6), int(box[1] * height + 1e-6)
+        right = int(math.ceil(box[2] * width - 1e-6))
+        bottom = int(math.ceil(box[3] * height - 1e-6))
+        if (left, top, right, bottom) == (0, 0, width, height):
+            return None
+        return (left, top, right, bottom)
+
+    # Rows or columns at a time for findEdges to look at.
+    cropStep = 16
+
+    def findContentBox(self, image):
+        """ The box autoCrop black then white would crop an RGB image to """
+        # Like autoCrop the white border is looked for inside what the
+        # black one left, with that part's own histogram. That's the whole
+        # image's less the black border's, which is usually small.
+        box = (0, 0) + image.size
+        histogram = image.histogram()
+        nonBlack = self.getBorderTables(histogram)[0]
+        found = self.findEdges(image, box, nonBlack)
+        if found is None:
+            return box # all black, autoCrop leaves it be
+
+        left, top, right, bottom = found
+        width, height = image.size
+        for strip in ((0, 0, width, top), (0, bottom, width, height),
+                      (0, top, left, bottom), (right, top, width, bottom)):
+            if strip[0] < strip[2] and strip[1] < strip[3]:
+                histogram = [a - b for a, b in
+                             zip(histogram, image.crop(strip).histogram())]
+        nonWhite = self.getBorderTables(histogram)[1]
+        return self.findEdges(image, found, nonWhite) or found
+
+    def findEdges(self, image, box, table):
+        """ The bbox of what table doesn't call border in box, None if none """
+        # Strips in from each edge in turn, stopping at the first content,
+        # so a picture with little or no border is barely looked at. Once
+        # the top is found the other edges are bound to be.
+        left, top, right, bottom = box
+        step = self.cropStep
+
+        def firstContent(strips, side):
+            for strip in strips:
+                found = self.getContentMask(image.crop(strip), table).getbbox()
+                if found is not None:
+                    return strip[side % 2] + found[side]
+            return None
+
+        top = firstContent([(left, y, right, min(y + step, bottom))
+                            for y in range(top, bottom, step)], 1)
+        if top is None:
+            return None
+        bottom = firstContent([(left, max(y - step, top), right, y)
+                               for y in range(bottom, top, -step)], 3)
+        left = firstContent([(x, top, min(x + step, right), bottom)
+                             for x in range(left, right, step)], 0)
+        right = firstContent([(max(x - step, left), top, x, bottom)
+                              for x in range(right, left, -step)], 2)
+        return (left, top, right, bottom)
+
+    def getBorderTables(self, histogram, cutoff = 5):
+        """ point() tables for what isn't black and what isn't white """
+        # Black and white as they'd be after ImageOps.autocontrast(image,
+        # cutoff) of the image with this histogram, like autoCrop, but
+        # without making the stretched copy.
+        nonBlack = []
+        nonWhite = []
+        for layer in range(0, len(histogram), 256):
+            table = getAutocontrastTable(histogram[layer:layer + 256], cutoff)
+            nonBlack.extend([v and 255 for v in table])
+            nonWhite.extend([(v < 255) and 255 or 0 for v in table])
+        return nonBlack, nonWhite
+
+    def getContentMask(self, image, table):
+        # Non-zero wherever some band isn't border by this table.
+        return image.point(table).convert('L')
 
     def maxAspectWallPaper_fill(self, image, width, height):
         # Blow up the image making sure that the smallest image aspect
@@ -383,6 +2732,7 @@ class Desktop(object):
         newImage = image.resize(newSize, rsFilter)
 
         if scale > 2:
+            from PIL import ImageFilter
             newImage = newImage.filter(ImageFilter.BLUR)
 
         imWidth, imHeight = newSize
@@ -417,10 +2767,173 @@ class Desktop(object):
             imWidth, imHeight = newSize
             x = int((imWidth - width) / 2.0)
             y = int((imHeight - height) / 2.0)
-            bbox = (x, 0, width + x, height + y)
+            bbox = (x, y, width + x, height + y)
             newImage = newImage.crop(bbox)
         return newImage
 
+    def fitToMonitor(self, image, size, box = None, rotate = False):
+        """ Crop to box, scale, rotate, centre and tint an image for a monitor """
+        # What cropping, preRotateImage, maxAspectWallPaper, the black
+        # canvas and the blend do, but nothing bigger than the monitor is
+        # made along the way. The crop is the resize's source box (Fill
+        # narrows it to just what will show), rotating is done after
+        # resizing, the canvas is only needed when the image doesn't fill
+        # the monitor, and the tint is a lookup table rather than a blend
+        # with a solid image.
+        stats = self.stats
+        width, height = size
+        if rotate:
+            # Resize on its side, then turn the monitor sized result.
+            width, height = height, width
+        if box is None:
+            box = (0, 0) + image.size
+        left, top, right, bottom = box
+        imWidth, imHeight = right - left, bottom - top
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        hScale = float(height) / float(imHeight)
+        wScale = float(width) / float(imWidth)
+        if self.Fill:
+            scale = max(hScale, wScale)
+        else:
+            scale = min(hScale, wScale)
+        rsFilter = Image.BICUBIC
+        if scale < 1:
+            rsFilter = Image.ANTIALIAS
+
+        with stats.timer('resize'):
+            if self.Fill:
+                dx = (imWidth - width / scale) / 2.0
+                dy = (imHeight - height / scale) / 2.0
+                newImage = image.resize((width, height), rsFilter,
+                                        (left + dx, top + dy,
+                                         right - dx, bottom - dy))
+            else:
+                newImage = image.resize((max(1, int(imWidth * scale)),
+                                         max(1, int(imHeight * scale))),
+                                        rsFilter, box)
+        stats.add('pixelsResized', newImage.size[0] * newImage.size[1])
+        if newImage.mode != 'RGB':
+            newImage = newImage.convert('RGB')
+        if rotate:
+            with stats.timer('preRotate'):
+                newImage = newImage.transpose(Image.ROTATE_270)
+            width, height = height, width
+
+        with stats.timer('blend'):
+            canvasColour = (0, 0, 0)
+            if self.Blending:
+                table = self.getBlendTable()
+                newImage = newImage.point(table)
+                # The tinted black of the canvas.
+                canvasColour = (table[0], table[256], table[512])
+
+            if newImage.size != (width, height):
+                canvas = Image.new('RGB', (width, height), canvasColour)
+                canvas.paste(newImage, ((width - newImage.size[0]) // 2,
+                                        (height - newImage.size[1]) // 2))
+                newImage = canvas
+        return newImage
+
+    def getBlendTable(self):
+        # Image.blend(solid bgColour, image, BlendRatio) as a point() table.
+        table = []
+        for c in self.bgColour[:3]:
+            table.extend([int(c + self.BlendRatio * (v - c))
+                          for v in range(256)])
+        return table
+
+    def getMinimumSourceSize(self, imageSize, size):
+        # The smallest the source image can be and still not need
+        # enlarging for the monitor, None if it already needs enlarging.
+        imWidth, imHeight = imageSize
+        width, height = size
+        if self.PreRotate and imWidth < imHeight:
+            width, height = height, width
+
+        hScale = float(height) / float(imHeight)
+        wScale = float(width) / float(imWidth)
+        if self.Fill:
+            scale = max(hScale, wScale)
+        else:
+            scale = min(hScale, wScale)
+
+        if self.Crop:
+            # Borders get cropped after loading so what's left is scaled up
+            # further, leave room for borders up to half the image.
+            scale *= 2
+        if scale >= 1:
+            return None
+        return (int(math.ceil(imWidth * scale)),
+                int(math.ceil(imHeight * scale)))
+
+    def reducedLoad(self, image, size):
+        needed = self.getMinimumSourceSize(image.size, size)
+        if needed is None:
+            return image
+
+        if image.format == 'JPEG':
+            # The JPEG decoder can scale by 1/2, 1/4 or 1/8 as it decodes,
+            # draft picks the smallest that's still at least this big.
+            image.draft('RGB', needed)
+            return image
+
+        # Everything else has to be decoded in full, but a power of two
+        # reduce is still much cheaper than resizing from full size.
+        if not hasattr(image, 'reduce'):
+            return image
+        factor = 1
+        while (image.size[0] // (factor * 2) >= needed[0] and
+               image.size[1] // (factor * 2) >= needed[1]):
+            factor *= 2
+        if factor > 1:
+            return image.reduce(factor)
+        return image
+
+    def getMaxPixels(self):
+        return int(self.MaxPixels * 1000000)
+
+    def limitDecode(self, image, size):
+        """ Have image decode within MaxPixels, or raise if it can't """
+        # Only the header has been read so far. The JPEG decoder can scale
+        # by 1/2, 1/4 or 1/8 as it decodes, anything else over MaxPixels
+        # would have to be decoded in full first so it's refused.
+        maxPixels = self.getMaxPixels()
+        width, height = image.size
+        if not maxPixels or width * height <= maxPixels:
+            if self.FastLoad:
+                return self.reducedLoad(image, size)
+            return image
+
+        # The scales that decode to few enough pixels.
+        factors = [f for f in (2, 4, 8)
+                   if ((width + f - 1) // f) * ((height + f - 1) // f)
+                   <= maxPixels]
+        if image.format != 'JPEG' or not factors:
+            self.stats.add('imagesRejected')
+            raise Exception("%dx%d %s image is over MaxPixels"
+                            % (width, height, image.format))
+
+        # draft only takes effect once, so it has to cover FastLoad too.
+        # It picks the smallest scale at least as big as it's asked for.
+        limit = (width // factors[0], height // factors[0])
+        needed = self.FastLoad and self.getMinimumSourceSize(image.size, size)
+        if needed and needed[0] <= limit[0] and needed[1] <= limit[1]:
+            image.draft('RGB', needed)
+        else:
+            image.draft('RGB', limit)
+            self.stats.add('imagesDowngraded')
+        return image
+
+    def getDecodeCost(self, image, size):
+        # Roughly the bytes rendering the image takes: PIL keeps 4 bytes a
+        # pixel for anything but greyscale and palette images, and there
+        # are a few monitor sized images on the way.
+        bytesPerPixel = image.mode in ('1', 'L', 'P') and 1 or 4
+        return (image.size[0] * image.size[1] * bytesPerPixel +
+                3 * 4 * size[0] * size[1])
+
     def preRotateImage(self,image):
         # Rotate 90 degrees.
         im = image.rotate(-90, resample = True, expand = True)
@@ -428,142 +2941,344 @@ class Desktop(object):
         # im = image.rotate(0, resample=True, expand=True)
         return im
 
+    @classmethod
+    def forRendering(cls, settings, cacheDir = None, cacheSize = 0,
+                     backend = None, cacheFormat = 'PNG', budget = None):
+        """ A Desktop that only renders wallpapers, for worker processes """
+        # Everything the rendering needs is in settings (renderSettings at
+        # least), it never reads the config.
+        d = cls(backend)
+        d.__dict__.update(settings)
+        setPixelLimit(d.getMaxPixels())
+        if cacheDir:
+            d.cache = RenderCache(cacheDir, cacheSize, cacheFormat)
+        d.decodeBudget = budget
+        d.writer = WallpaperWriter(d.OutputFormat, d.OutputQuality, d.stats)
+        return d
+
+    def getRenderSettings(self):
+        return dict((name, getattr(self, name)) for name in self.renderSettings)
+
     def createWallPaperFromFile(self, pathToImage, monitor):
+        # Rendering is the expensive part, so reuse an earlier render of
+        # the same image for a monitor of the same size if we have one.
+        if self.cache is None:
+            return self.renderWallPaperFromFile(pathToImage, monitor)
+
+        key = self.cache.makeKey(pathToImage, monitor.size,
+                                 self.getRenderSettings())
+        with self.stats.timer('cacheGet'):
+            img = self.cache.get(key)
+        if img is None:
+            self.stats.add('cacheMisses')
+            img = self.renderWallPaperFromFile(pathToImage, monitor)
+            with self.stats.timer('cachePut'):
+                self.cache.put(key, img)
+        else:
+            self.stats.add('cacheHits')
+        return img
+
+    def renderWallPaperFromFile(self, pathToImage, monitor):
         # Given a path to an image, convert it to bmp format and set it as
         # the wallpaper
 
-        bmpImage = Image.open(pathToImage)
+        stats = self.stats
+        with stats.timer('readHeader'):
+            bmpImage = Image.open(pathToImage)
+            bmpImage = self.limitDecode(bmpImage, monitor.size)
+
+        cost = self.getDecodeCost(bmpImage, monitor.size)
+        if self.decodeBudget is not None:
+            with stats.timer('decodeWait'):
+                if self.decodeBudget.acquire(cost):
+                    stats.add('decodeWaits')
+        try:
+            with stats.timer('decode'):
+                bmpImage.load()
+            return self.renderDecoded(bmpImage, pathToImage, monitor)
+        finally:
+            if self.decodeBudget is not None:
+                self.decodeBudget.release(cost)
+
+    def renderDecoded(self, bmpImage, pathToImage, monitor):
+        stats = self.stats
+        if stats.enabled:
+            stats.add('imagesDecoded')
+            stats.add('fileBytes', os.path.getsize(pathToImage))
+            stats.add('decodedBytes', bmpImage.size[0] * bmpImage.size[1] *
+                      len(bmpImage.getbands()))
+
+        # Cropping first leaves less to rotate, but whether to rotate is
+        # still down to the shape of the whole image.
+        portrait = bmpImage.size[0] < bmpImage.size[1]
+        if self.FusedRender:
+            # The crop and rotation happen as part of the resize.
+            box = None
+            if self.Crop:
+                with stats.timer('autoCrop'):
+                    box = self.getCropBox(bmpImage, pathToImage)
+            return self.fitToMonitor(bmpImage, monitor.size, box,
+                                     self.PreRotate and portrait)
 
-        if self.PreRotate:
-            if bmpImage.size[0] < bmpImage.size[1]:
-                bmpImage = self.preRotateImage(bmpImage)
-        
         if self.Crop:
-            bmpImage = self.autoCrop(bmpImage, (0,0,0))
-            bmpImage = self.autoCrop(bmpImage, (255,255,255))
+            with stats.timer('autoCrop'):
+                bmpImage = self.cropBorders(bmpImage, pathToImage)
+
+        if self.PreRotate:
+            if portrait:
+                with stats.timer('preRotate'):
+                    bmpImage = self.preRotateImage(bmpImage)
             
-        bmpImage = self.maxAspectWallPaper(bmpImage, *monitor.size)
+        with stats.timer('resize'):
+            bmpImage = self.maxAspectWallPaper(bmpImage, *monitor.size)
+        stats.add('pixelsResized', bmpImage.size[0] * bmpImage.size[1])
 
         bmpSize = bmpImage.size
         xOffset = int((monitor.size[0] - bmpImage.size[0]) / 2)
         yOffset = int((monitor.size[1] - bmpImage.size[1]) / 2)
 
-        if bmpImage.size != monitor.size:
-            img1 = Image.new("RGB", monitor.size, (0, 0, 0))
-        img1.paste(bmpImage, (xOffset, yOffset))
+        with stats.timer('compose'):
+            if bmpImage.size != monitor.size:
+                img1 = Image.new("RGB", monitor.size, (0, 0, 0))
+                img1.paste(bmpImage, (xOffset, yOffset))
+            else:
+                img1 = bmpImage.convert("RGB")
 
         if self.Blending:
-            img2 = Image.new("RGB", monitor.size, self.bgColour)
-            return Image.blend(img2, img1, self.BlendRatio)
+            with stats.timer('blend'):
+                img2 = Image.new("RGB", monitor.size, self.bgColour)
+                return Image.blend(img2, img1, self.BlendRatio)
         return img1
 
-    def setWallpaperStyleSingle(self):
-        # 0x80000001 == HKEY_CURRENT_USER
-        k = win32api.RegOpenKeyEx(win32con.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,win32con.KEY_SET_VALUE)
-        win32api.RegSetValueEx(k, "WallpaperStyle", 0, win32con.REG_SZ, "0")
-        win32api.RegSetValueEx(k, "TileWallpaper", 0, win32con.REG_SZ, "0")
+    def setWallpaperStyle(self):
+        self.backend.setWallpaperStyle(len(self.monitors) > 1)
 
-    def setWallpaperStyleMulti(self):
-        # To set a multi-monitor wallpaper, we need to tile it...
-        # 0x80000001 == HKEY_CURRENT_USER
-        k = win32api.RegOpenKeyEx(win32con.HKEY_CURRENT_USER,"Control Panel\\Desktop",0,win32con.KEY_SET_VALUE)
-        win32api.RegSetValueEx(k, "WallpaperStyle", 0, win32con.REG_SZ, "0")
-        win32api.RegSetValueEx(k, "TileWallpaper", 0, win32con.REG_SZ, "1")
+    def getWallpaperPath(self):
+        if self.outputPath:
+            return self.outputPath
+        # Save the new wallpaper in our current directory.
+        return self.writer.getPath(os.getcwd())
 
-    def setWallpaperStyle(self):
-        if len(self.monitors) > 1:
-            self.setWallpaperStyleMulti()
+    def setWallpaper(self):
+        newPath = self.getWallpaperPath()
+        if self.compositor is not None:
+            written = self.compositor.write(newPath, self.wSize,
+                                            self.getBackgroundColumn(),
+                                            self.monitors, self.stats)
         else:
-            self.setWallpaperStyleSingle()
+            written = self.writer.write(self.bgImage, newPath)
+        if not written:
+            # Nothing changed, so Windows already has it.
+            return
 
-    def setWallpaper(self):
-        self.setWallpaperStyle()
+        with self.stats.timer('setWallpaper'):
+            self.setWallpaperStyle()
+            self.setWallPaperFromBmp(newPath)
 
-        # Save the new wallpaper in our current directory.
-        newPath = os.getcwd()
-        newPath = os.path.join(newPath, 'pywallpaper.bmp')
-        self.bgImage.save(newPath, "BMP")
-        self.setWallPaperFromBmp(newPath)
+    def loadPreviousWallpaper(self):
+        # When only some monitors are changing, start from what's on the
+        # desktop now rather than a blank canvas.
+        if self.compositor is not None:
+            # The other monitors' tiles are still on disk.
+            return
+        try:
+            image = Image.open(self.getWallpaperPath())
+            if image.size == tuple(self.wSize):
+                self.bgImage = image.convert('RGB')
+        except (IOError, OSError):
+            pass
 
     def setWallpaperFromFile(self, pathToImage):
-        for monitor in self.monitors:
-            img = self.createWallPaperFromFile(filename, monitor)
-            monitor.addWallpaper(self.bgImage, img)
+        self.applyFrame(self.renderImageFrame(pathToImage))
 
-        self.setWallpaper()
+    def renderImageFrame(self, pathToImage):
+        """ Render the one image for every monitor """
+        return [(monitor, self.keepWallpaper(
+                    monitor, self.createWallPaperFromFile(pathToImage, monitor)))
+                for monitor in self.monitors]
+
+    def keepWallpaper(self, monitor, img):
+        # What a frame holds for a rendered monitor. When streaming it goes
+        # straight out to disk so only one monitor is in memory at a time.
+        if self.compositor is None:
+            return img
+        return self.compositor.saveTile(monitor, img)
 
     def setWallPaperFromFileList(self, pathToDir, monitor):
         """ Given a directory choose an image from it and set it as a wallpaper """
+        img = self.renderWallPaperFromFileList(pathToDir, monitor)
+        if img is None:
+            return False
+        monitor.addWallpaper(self.bgImage, img)
+        return True
+
+    def renderWallPaperFromFileList(self, pathToDir, monitor):
+        """ Given a directory choose an image from it and render it for monitor """
         # Image directories often contain Thumbs.db or other non-image
         # files or directories, try a few times to set a wallpaper, and then just give up.
 
         tries = 0
-        done = False
-        filenames = []
-        files = os.listdir(pathToDir)
-
-        try:
-            # Priorwalls.txt is used so that we don't repeat an image
-            # until every other image in that directory has been seen
-            # The file is rewritten when necessary.
-            prevList = open('priorWalls.txt', 'rb')
-            filenames = [l.strip() for l in prevList.readlines()]
-            prevList.close()
-        except:
-            pass
-
-        files = [os.path.join(pathToDir, f) for f in files if not f.endswith('.db')]
-        availChoices = [f for f in files if not f in filenames and not f.endswith('.db')]
+        img = None
 
-        if not availChoices:
-            # This entire directory has been "done" remove them
-            # from the previously seen wallpapers and rewrite
-            # the cache file without any of these entries.
-            filenames = [f for f in filenames if not f in files]
-            availChoices = files
-            p = open('priorWalls.txt', 'wb')
-            for f in filenames:
-                p.write("%s\n"%(f))
-            p.close()
-
-        files = availChoices
-
-        while (not done) and tries < 3:
+        while img is None and tries < 3:
             # Thumbs.db and other stuff can live in the same Folder
             # So try three times to set a wallpaper before giving up.
+            filename = self.chooseWallPaper(pathToDir, monitor)
+            if filename is None:
+                print >> sys.stderr, pathToDir, "has no usable images"
+                break
             try:
-                image = random.choice(files)
-                filename = image
                 img = self.createWallPaperFromFile(filename, monitor)
-                monitor.addWallpaper(self.bgImage, img)
-                prevList = open('priorWalls.txt', 'ab')
-                prevList.write("%s\n"%(filename))
-                done = True
-            except:
-                import traceback; traceback.print_exc()
+            except Exception, e:
+                traceback.print_exc()
                 print >> sys.stderr, filename, "failed"
+                if isDecodeError(e):
+                    self.index.markBroken(filename)
+                img = None
                 tries += 1
-        return done
+                self.stats.add('renderRetries')
+        return img
+
+    def chooseWallPaper(self, pathToDir, monitor):
+        """ The next image from a directory we haven't shown this round """
+        # Only relists the directory if it has changed since last time.
+        self.refreshDirectory(pathToDir)
+        generation = self.index.getGeneration(pathToDir, self.Recursive)
+
+        if not self.AspectMatch:
+            return self.deck.draw(pathToDir, generation,
+                                  lambda: self.index.getImages(
+                                      pathToDir, self.Recursive, self.Dedup,
+                                      self.getMaxPixels()))
+
+        # Monitors of a different shape get different images, so they
+        # need their own deck.
+        name = '%s|%dx%d|%s|%s' % (pathToDir, monitor.size[0],
+                                   monitor.size[1], self.AspectTolerance,
+                                   self.PreRotate)
+        def getCandidates():
+            return (self.index.getImagesForSize(pathToDir, monitor.size,
+                                                self.AspectTolerance,
+                                                self.PreRotate,
+                                                self.Recursive,
+                                                self.Dedup,
+                                                self.getMaxPixels()) or
+                    self.index.getImages(pathToDir, self.Recursive,
+                                         self.Dedup, self.getMaxPixels()))
+        return self.deck.draw(name, generation, getCandidates)
+
+    def chooseImageDirectory(self, monIndex):
+        dirs = self.getMonitorDirs(monIndex)
+        if self.Dedup and len(dirs) > 1:
+            # A directory of nothing but copies of images kept elsewhere
+            # would only bring the copies back.
+            dirs = [d for d in dirs
+                    if self.index.hasImages(d, self.Recursive, True)] or dirs
+        return random.choice(dirs)
 
     def getMonitorDirs(self, monIndex):
         section = 'monitor_%d'%(monIndex)
-        # Check for [monitor_0]
-        if self.config.has_section(section):
-            # check for its own paths section
-            if self.config.has_option(section, 'paths'):
-                dirs = self.config.get(section, 'paths').split('\n')
+        # Check for [monitor_0] with its own paths, it may only have an
+        # interval.
+        if self.config.has_option(section, 'paths'):
+            dirs = self.config.get(section, 'paths').split('\n')
         else:
             dirs = self.dirs
 
         return dirs
 
-    def setWallPaperFromDirList(self):
+    def setWallPaperFromDirList(self, monNums = None):
         """ Given a list of directories choose a directory """
-        for monNum, monitor in enumerate(self.monitors):
-            imageDir = random.choice(self.getMonitorDirs(monNum))
-            status = self.setWallPaperFromFileList(imageDir, monitor)
-
+        self.applyFrame(self.renderFrame(monNums))
+
+    def getMonitorNumbers(self, monNums = None):
+        if monNums is None:
+            return range(len(self.monitors))
+        return [n for n in monNums if 0 <= n < len(self.monitors)]
+
+    def renderFrame(self, monNums = None):
+        """ Choose and render the next wallpaper for monitors (default all) """
+        # Only the monitors in the frame get repainted, everything else
+        # keeps whatever is already on the canvas.
+        # Timed mode renders on its worker while other threads may be
+        # crawling, and there's only one index and deck.
+        with self.renderLock:
+            if self.pool is not None:
+                return self.renderFrameInPool(monNums)
+            return self.renderFrameHere(monNums)
+
+    def renderFrameHere(self, monNums = None):
+        frame = []
+        monitors = self.monitors
+        for monNum in self.getMonitorNumbers(monNums):
+            monitor = monitors[monNum]
+            imageDir = self.chooseImageDirectory(monNum)
+            img = self.renderWallPaperFromFileList(imageDir, monitor)
+            if img is not None:
+                frame.append((monitor, self.keepWallpaper(monitor, img)))
+        return frame
+
+    def renderFrameInPool(self, monNums = None):
+        # Start every monitor rendering at once, anything that fails is
+        # retried here the slow way.
+        jobs = []
+        monitors = self.monitors
+        for monNum in self.getMonitorNumbers(monNums):
+            monitor = monitors[monNum]
+            imageDir = self.chooseImageDirectory(monNum)
+            filename = self.chooseWallPaper(imageDir, monitor)
+            if filename is None:
+                print >> sys.stderr, imageDir, "has no usable images"
+                continue
+            job = self.pool.apply_async(renderWorker, (filename, monitor))
+            jobs.append((imageDir, monitor, filename, job))
+
+        frame = []
+        for imageDir, monitor, filename, job in jobs:
+            buf, pending, broken = job.get()
+            self.stats.merge(pending)
+            img = imageFromBuffer(buf)
+            if img is None:
+                print >> sys.stderr, filename, "failed"
+                if broken:
+                    self.index.markBroken(filename)
+                self.stats.add('renderRetries')
+                img = self.renderWallPaperFromFileList(imageDir, monitor)
+            if img is not None:
+                frame.append((monitor, self.keepWallpaper(monitor, img)))
+        return frame
+
+    def applyFrame(self, frame):
+        with self.stats.timer('addWallpaper'):
+            if self.compositor is not None:
+                self.compositor.commit([tile for monitor, tile in frame])
+            else:
+                # The frame may have been rendered before the monitors
+                # changed, so place each wallpaper with the current layout.
+                monitors = dict((m.key, m) for m in self.monitors)
+                for monitor, img in frame:
+                    current = monitors.get(monitor.key)
+                    if current is not None and current.size == monitor.size:
+                        current.addWallpaper(self.bgImage, img)
         self.setWallpaper()
+        self.recordChange(len(frame), len(self.monitors))
+
+    def recordChange(self, monitorsChanged, monitors):
+        self.stats.add('changes')
+        self.stats.add('monitorsChanged', monitorsChanged)
+        if self.reportStats:
+            self.stats.report()
+        if self.MetricsFile:
+            self.stats.writeMetrics(self.MetricsFile, monitors = monitors)
+
+    def getMonitorInterval(self, monIndex, default):
+        # [monitor_N] can have its own interval in minutes.
+        section = 'monitor_%d'%(monIndex)
+        if self.config.has_option(section, 'interval'):
+            interval = self.config.getfloat(section, 'interval') * 60.0
+            if interval > 0:
+                return interval
+        return default
 
     def getImageDirectories(self):
         # Set global image directories.
@@ -580,6 +3295,69 @@ class Desktop(object):
     def setWallPaperFromConfigDirs(self):
         self.setWallPaperFromDirList()
 
+    def getPrerenderedPath(self):
+        return self.getWallpaperPath() + '.next'
+
+    def getPrerenderKey(self):
+        """ What a prerendered wallpaper was rendered for """
+        # All cheap enough to check before the monitors are enumerated. The
+        # config covers the render settings and directories, the images
+        # were chosen when it was rendered.
+        try:
+            colour = self.backend.getDesktopColour()
+        except Exception:
+            colour = None
+        config = os.stat(self.configFile)
+        return hashlib.sha1(repr((self.backend.getFingerprint(), colour,
+                                  config.st_mtime, config.st_size,
+                                  list(self.dirs), self.getWallpaperPath(),
+                                  self.writer.format))).hexdigest()
+
+    def setPrerendered(self):
+        """ Put up what the last run prerendered, False if we can't """
+        pathToNext = self.getPrerenderedPath()
+        prerendered = loadJson(pathToNext + '.json')
+        if prerendered is None:
+            return False
+        try:
+            # Whatever happens it's only good for one go.
+            os.remove(pathToNext + '.json')
+        except OSError:
+            return False
+        if (prerendered.get('key') != self.getPrerenderKey() or
+            not os.path.exists(pathToNext)):
+            self.stats.add('prerenderMisses')
+            return False
+
+        # The wallpaper style was set for this layout when the last
+        # wallpaper went up.
+        newPath = self.getWallpaperPath()
+        with self.stats.timer('setWallpaper'):
+            replaceFile(pathToNext, newPath)
+            if os.path.exists(pathToNext + '.digest'):
+                replaceFile(pathToNext + '.digest', newPath + '.digest')
+            self.setWallPaperFromBmp(newPath)
+        self.stats.add('prerenderHits')
+        self.recordChange(prerendered['monitors'], prerendered['monitors'])
+        return True
+
+    def prerenderNext(self):
+        """ Render the next run's wallpaper, see setPrerendered """
+        if self.compositor is not None:
+            # The tiles on disk have to stay the wallpaper that's up.
+            return
+        self.createEmptyWallpaper()
+        frame = self.renderFrame()
+        if not frame:
+            return
+        with self.stats.timer('prerender'):
+            for monitor, img in frame:
+                monitor.addWallpaper(self.bgImage, img)
+            pathToNext = self.getPrerenderedPath()
+            self.writer.write(self.bgImage, pathToNext)
+            saveJson(pathToNext + '.json', {'key': self.getPrerenderKey(),
+                                            'monitors': len(self.monitors)})
+
     def getConfigFileOptions(self, options):
         configFile = 'pywallpaper.conf'
 
@@ -588,8 +3366,17 @@ class Desktop(object):
 
         dirs = options.directories
 
-        self.config = SafeConfigParser()
-        self.config.readfp(open(configFile))
+        # Remembered so timed mode can re-read it after changing directory.
+        self.configFile = os.path.abspath(configFile)
+        # Parsed on the side, a half saved file mustn't leave a half read
+        # parser behind.
+        config = SafeConfigParser()
+        f = open(configFile)
+        try:
+            config.readfp(f)
+        finally:
+            f.close()
+        self.config = config
 
         if self.config.has_section('global'):
             self.Blending = self.config.getboolean('global', 'Blending')
@@ -598,6 +3385,161 @@ class Desktop(object):
             self.Fill = self.config.getboolean('global', 'Fill')
             self.Gradient = self.config.getboolean('global', 'Gradient')
             self.PreRotate = self.config.getboolean('global', 'PreRotate')
+            self.IndexFile = self.getConfigOption('global', 'IndexFile',
+                                                  self.IndexFile)
+            self.AspectMatch = self.getConfigOption('global', 'AspectMatch',
+                                                    self.AspectMatch)
+            self.AspectTolerance = self.getConfigOption('global',
+                                                        'AspectTolerance',
+                                                        self.AspectTolerance)
+            self.RenderCache = self.getConfigOption('global', 'RenderCache',
+                                                    self.RenderCache)
+            self.RenderCacheDir = self.getConfigOption('global',
+                                                       'RenderCacheDir',
+                                                       self.RenderCacheDir)
+            self.RenderCacheSize = self.getConfigOption('global',
+                                                        'RenderCacheSize',
+                                                        self.RenderCacheSize)
+            self.RenderCacheFormat = self.getConfigOption(
+                'global', 'RenderCacheFormat', self.RenderCacheFormat)
+            self.Prefetch = self.getConfigOption('global', 'Prefetch',
+                                                 self.Prefetch)
+            self.TopologyPoll = self.getConfigOption('global', 'TopologyPoll',
+                                                     self.TopologyPoll)
+            self.ConfigPoll = self.getConfigOption('global', 'ConfigPoll',
+                                                   self.ConfigPoll)
+            self.RescanInterval = self.getConfigOption('global',
+                                                       'RescanInterval',
+                                                       self.RescanInterval)
+            self.ControlPort = self.getConfigOption('global', 'ControlPort',
+                                                    self.ControlPort)
+            self.Recursive = self.getConfigOption('global', 'Recursive',
+                                                  self.Recursive)
+            self.CrawlThreads = self.getConfigOption('global', 'CrawlThreads',
+                                                     self.CrawlThreads)
+            self.CrawlTimeout = self.getConfigOption('global', 'CrawlTimeout',
+                                                     self.CrawlTimeout)
+            self.Dedup = self.getConfigOption('global', 'Dedup', self.Dedup)
+            self.DedupDistance = self.getConfigOption('global',
+                                                      'DedupDistance',
+                                                      self.DedupDistance)
+            self.FastLoad = self.getConfigOption('global', 'FastLoad',
+                                                 self.FastLoad)
+            self.FusedRender = self.getConfigOption('global', 'FusedRender',
+                                                    self.FusedRender)
+            self.MaxPixels = self.getConfigOption('global', 'MaxPixels',
+                                                  self.MaxPixels)
+            self.DecodeMemory = self.getConfigOption('global', 'DecodeMemory',
+                                                     self.DecodeMemory)
+            self.OutputFormat = self.getConfigOption('global', 'OutputFormat',
+                                                     self.OutputFormat)
+            self.OutputQuality = self.getConfigOption('global',
+                                                      'OutputQuality',
+                                                      self.OutputQuality)
+            self.MetricsFile = self.getConfigOption('global', 'MetricsFile',
+                                                    self.MetricsFile)
+            self.Streaming = self.getConfigOption('global', 'Streaming',
+                                                  self.Streaming)
+            self.TileDir = self.getConfigOption('global', 'TileDir',
+                                                self.TileDir)
+            self.RenderProcesses = self.getConfigOption('global',
+                                                        'RenderProcesses',
+                                                        self.RenderProcesses)
+            self.PrerenderNext = self.getConfigOption('global',
+                                                      'PrerenderNext',
+                                                      self.PrerenderNext)
+        setPixelLimit(self.getMaxPixels())
+
+    def reloadConfig(self, options):
+        """ Re-read the config file, True if what gets rendered changed """
+        # The index, crawler, cache, output and control port stay as they
+        # were.
+        before = self.getRenderSettings(), self.Gradient
+        saved = dict(self.__dict__)
+        options.configFile = self.configFile
+        try:
+            self.getConfigFileOptions(options)
+            self.dirs = options.directories or self.getImageDirectories()
+        except Exception:
+            # Carry on with the settings, directories and intervals from
+            # before rather than whatever was read before it went wrong.
+            self.__dict__.update(saved)
+            raise
+        self.setMetrics(options)
+        return (self.getRenderSettings(), self.Gradient) != before
+
+    def setMetrics(self, options):
+        # --metrics beats MetricsFile in the config, both relative to the
+        # working directory.
+        if options.metrics:
+            self.MetricsFile = options.metrics
+        if self.MetricsFile:
+            self.MetricsFile = os.path.abspath(self.MetricsFile)
+        self.stats.enabled = bool(self.reportStats or self.MetricsFile or
+                                  (options.change_time and self.ControlPort))
+
+    def rescanDirectory(self, pathToDir):
+        """ Start bringing the index up to date with an image directory """
+        self.crawler.crawl([pathToDir])
+
+    def updateDirectories(self, dirs, force = False):
+        """ Bring the index up to date with all of these directories """
+        if self.crawler is None:
+            self.index.update(dirs, force, self.Recursive)
+            return
+        self.crawler.crawl(dirs, force)
+        for pathToDir in dirs:
+            self.crawler.wait(pathToDir)
+
+    def refreshDirectory(self, pathToDir):
+        # Wait for the directory to be listed, or at least to have turned
+        # up some images. In timed mode directories are rescanned on their
+        # own timer so only the first time counts.
+        if self.crawler is None:
+            self.index.updateDirectory(pathToDir, recursive = self.Recursive)
+            return
+        if self.RescanInterval <= 0 or not self.crawler.isCrawled(pathToDir):
+            self.crawler.crawl([pathToDir])
+        self.crawler.wait(pathToDir, partial = True)
+
+    def sendCommand(self, line):
+        """ Send a command to timed mode's ControlPort, returns the reply """
+        if not self.ControlPort:
+            raise Exception("No ControlPort in the config")
+        sock = socket.create_connection(('127.0.0.1', self.ControlPort))
+        try:
+            sock.sendall(line + '\n')
+            sock.shutdown(socket.SHUT_WR)
+            reply = []
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                reply.append(data)
+            return ''.join(reply)
+        finally:
+            sock.close()
+
+    def getConfigOption(self, section, option, default):
+        # Newer options are optional so that old config files still work,
+        # the type of the default decides how the value is parsed.
+        if not self.config.has_option(section, option):
+            return default
+        if isinstance(default, bool):
+            return self.config.getboolean(section, option)
+        if isinstance(default, int):
+            return self.config.getint(section, option)
+        if isinstance(default, float):
+            return self.config.getfloat(section, option)
+        return self.config.get(section, option)
+
+    def getAllImageDirectories(self):
+        dirs = list(self.dirs)
+        for section in self.config.sections():
+            if (section.startswith('monitor_') and
+                self.config.has_option(section, 'paths')):
+                dirs.extend(self.config.get(section, 'paths').split('\n'))
+        return dirs
 
     def getCommandLineOptions(self):
         parser = OptionParser()
@@ -617,27 +3559,295 @@ class Desktop(object):
         parser.add_option("-w", "--workingdir", dest="cwd", default=".",
                           help = "Working Directory (default .)")
 
+        parser.add_option("-l", "--layout", dest="layouts", default = [],
+                          action="append", type="string",
+                          help = "Render for the monitors in this JSON layout file instead of the desktop (can be repeated with --batch)")
+
+        parser.add_option("--batch", dest="batchDir", default = None,
+                          help = "Render every image (or -i) for every layout (-l) into this directory and exit")
+
+        parser.add_option("-o", "--output", dest="output", default = None,
+                          help = "Write the wallpaper here (default <working dir>/pywallpaper.bmp)")
+
+        parser.add_option("-m", "--monitor", dest="monitors", default = [],
+                          action="append", type="int",
+                          help = "Only change this monitor's wallpaper and exit (0 = primary, can be repeated)")
+
+        parser.add_option("-b", "--benchmark", dest="benchmark", default = None,
+                          help = "Run a benchmark and exit (fastload, gradient, streaming, pipeline, autocrop, fused, crawl, dedup, paste, startup, layout)")
+
+        parser.add_option("--baseline", dest="baseline", default = None,
+                          help = "Compare the pipeline benchmark with this file, or save it there if there isn't one")
+
+        parser.add_option("-s", "--stats", "--profile", dest="stats",
+                          default = False, action="store_true",
+                          help = "Print counters and stage timings for each wallpaper change to stderr")
+
+        parser.add_option("--metrics", dest="metrics", default = None,
+                          help = "Append a JSON line of counters and stage timings for each change to this file")
+
+        parser.add_option("--send", dest="send", default = None,
+                          help = "Send a command to timed mode running with a ControlPort (next [n...], pause, resume, status, stats, reload, quit)")
+
+        parser.add_option("-r", "--reindex", dest="reindex", default = False,
+                          action="store_true",
+                          help = "Re-read every image in the image directories into the index")
+
         (options, args) = parser.parse_args()
         return (options, args)
 
+    def getBackend(self, options):
+        layout = options.layouts and options.layouts[0]
+        if not layout and self.config.has_option('global', 'Layout'):
+            layout = self.config.get('global', 'Layout')
+        if layout:
+            return HeadlessBackend.fromFile(layout)
+        if windll is None:
+            raise Exception("Not running on windows, give a monitor layout "
+                            "with -l or Layout in the config.")
+        return Win32Backend()
+
+    def startRenderPool(self):
+        cacheDir = None
+        if self.cache is not None:
+            cacheDir = os.path.abspath(self.cache.pathToCache)
+        # Workers that were terminated may have gone holding some of the
+        # old budget.
+        self.decodeBudget = self.getDecodeBudget()
+        self.pool = multiprocessing.Pool(
+            self.RenderProcesses, initRenderWorker,
+            (self.getRenderSettings(), cacheDir,
+             self.RenderCacheSize * 1024 * 1024, self.stats.enabled,
+             os.path.abspath(self.index.pathToIndex), self.RenderCacheFormat,
+             self.decodeBudget))
+
+    def getDecodeBudget(self):
+        if self.DecodeMemory <= 0:
+            return None
+        return MemoryBudget(self.DecodeMemory * 1024 * 1024)
+
+    def restartRenderPool(self):
+        # The workers were started with the old render settings.
+        with self.renderLock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.startRenderPool()
+
+    def getAllImages(self):
+        dirs = self.getAllImageDirectories()
+        self.updateDirectories(dirs)
+        images = []
+        maxPixels = self.getMaxPixels()
+        for pathToDir in dirs:
+            images.extend(self.index.getImages(pathToDir, self.Recursive,
+                                               maxPixels = maxPixels))
+        return images
+
+    def renderBatch(self, options):
+        """ Render every image for every layout into options.batchDir """
+        # The manifest records what each output was rendered from, so a
+        # rerun (or a resumed one) only renders what is missing or out of
+        # date and clients can find the file for their layout.
+        if not options.layouts:
+            raise Exception("--batch needs at least one layout (-l)")
+
+        outputDir = options.batchDir
+        pathToManifest = os.path.join(outputDir, 'manifest.json')
+        manifest = loadJson(pathToManifest, {'layouts': {}, 'outputs': {}})
+
+        if options.singleImage:
+            images = [options.singleImage]
+        else:
+            images = self.getAllImages()
+
+        settings = self.getRenderSettings()
+        settings.update(Gradient = self.Gradient,
+                        OutputFormat = self.writer.format,
+                        OutputQuality = self.OutputQuality)
+        settingsKey = repr(sorted(settings.items()))
+        ext = self.writer.extensions[self.writer.format]
+
+        tasks = []
+        upToDate = 0
+        for pathToLayout in options.layouts:
+            pathToLayout = os.path.abspath(pathToLayout)
+            layoutName = os.path.splitext(os.path.basename(pathToLayout))[0]
+            f = open(pathToLayout, 'rb')
+            layoutData = f.read()
+            f.close()
+            manifest['layouts'][layoutName] = {
+                'layout': pathToLayout,
+                'monitors': json.loads(layoutData)['monitors'],
+                }
+            if not os.path.isdir(os.path.join(outputDir, layoutName)):
+                os.makedirs(os.path.join(outputDir, layoutName))
+
+            for pathToImage in images:
+                pathToImage = os.path.abspath(pathToImage)
+                st = os.stat(pathToImage)
+                key = hashlib.sha1(repr((pathToImage, st.st_mtime, st.st_size,
+                                         layoutData, settingsKey))).hexdigest()
+                name = '%s-%s%s' % (
+                    os.path.splitext(os.path.basename(pathToImage))[0],
+                    hashlib.sha1(pathToImage).hexdigest()[:8], ext)
+                output = layoutName + '/' + name
+
+                entry = manifest['outputs'].get(output)
+                pathToOutput = os.path.join(outputDir, layoutName, name)
+                if (entry and entry['key'] == key and
+                    os.path.exists(pathToOutput)):
+                    upToDate += 1
+                    continue
+                tasks.append((pathToImage, pathToLayout, pathToOutput,
+                              output, layoutName, key))
+
+        print '%d to render, %d up to date' % (len(tasks), upToDate)
+
+        cacheDir = None
+        if self.cache is not None:
+            cacheDir = os.path.abspath(self.cache.pathToCache)
+        processes = self.RenderProcesses or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, initBatchWorker,
+                                    (settings, cacheDir,
+                                     self.RenderCacheSize * 1024 * 1024,
+                                     self.RenderCacheFormat,
+                                     self.getDecodeBudget()))
+        done = 0
+        failed = 0
+        start = time.time()
+        try:
+            for task, seconds, error in pool.imap_unordered(batchWorker, tasks):
+                pathToImage, pathToLayout, pathToOutput, output, layoutName, key = task
+                if error:
+                    print >> sys.stderr, pathToImage, layoutName, "failed"
+                    print >> sys.stderr, error
+                    failed += 1
+                    continue
+
+                manifest['outputs'][output] = {
+                    'image': pathToImage,
+                    'layout': layoutName,
+                    'key': key,
+                    }
+                done += 1
+                # Checkpoint so that an interrupted run can pick up here.
+                if done % 50 == 0:
+                    saveJson(pathToManifest, manifest, indent = 1,
+                             sort_keys = True)
+                    print '%d/%d rendered' % (done, len(tasks))
+        finally:
+            pool.terminate()
+            saveJson(pathToManifest, manifest, indent = 1, sort_keys = True)
+
+        print '%d rendered, %d failed in %.1fs' % (done, failed,
+                                                   time.time() - start)
+
     def go(self):
         options, args = self.getCommandLineOptions()
         self.getConfigFileOptions(options)
 
-        self.dirs = self.getImageDirectories()
+        if options.send:
+            print self.sendCommand(options.send),
+            return
+
+        if options.benchmark:
+            # They live beside this script, only -b needs them.
+            import pywallpaper_benchmarks as benchmarks
+        # Synthetic benchmarks need no desktop (or layout) and mustn't
+        # wait on a crawl of the image directories.
+        synthetic = options.benchmark and \
+            options.benchmark in benchmarks.synthetic
+        if self.backend is None and not synthetic:
+            self.backend = self.getBackend(options)
+
+        self.dirs = options.directories or self.getImageDirectories()
         
         if options.cwd and options.cwd != '.':
-            os.cwd(cwd)
-        if options.singleImage:
-            self.setWallPaper(options.singleImage)
-            
-        elif not options.change_time:
-            self.setWallPaperFromConfigDirs()
-        else:
-            sleepTime = options.change_time * 60.0
-            while True:
-                self.setWallPaperFromDirList()
-                time.sleep(sleepTime)
+            os.chdir(options.cwd)
+
+        if synthetic:
+            benchmarks.run(self, options.benchmark, options)
+            return
+
+        if options.output:
+            self.outputPath = os.path.abspath(options.output)
+            self.OutputFormat = WallpaperWriter.getFormat(options.output,
+                                                          self.OutputFormat)
+        self.writer = WallpaperWriter(self.OutputFormat, self.OutputQuality,
+                                      self.stats)
+        self.reportStats = options.stats
+        self.setMetrics(options)
+
+        # A plain one-shot run puts up what the last one rendered, if it
+        # can, before even enumerating the monitors.
+        oneShot = not (options.singleImage or options.monitors or
+                       options.change_time or options.benchmark or
+                       options.batchDir or options.reindex)
+        prerendered = oneShot and self.PrerenderNext and self.setPrerendered()
+        self.setMonitorExtents()
+
+        if self.Streaming and not options.batchDir:
+            if self.writer.format != 'BMP':
+                raise Exception("Streaming only writes BMP wallpapers")
+            self.compositor = StreamingCompositor(self.TileDir)
+
+        # Blending and Gradient come from the config.
+        self.createEmptyWallpaper()
+
+        self.decodeBudget = self.getDecodeBudget()
+        self.index = ImageIndex(self.IndexFile)
+        self.deck = RotationDeck(self.index)
+        self.crawler = DirectoryCrawler(self.IndexFile, self.CrawlThreads,
+                                        self.CrawlTimeout, self.Recursive,
+                                        self.stats, self.Dedup,
+                                        self.DedupDistance,
+                                        self.getMaxPixels(),
+                                        self.decodeBudget)
+        # However we leave, the index gets to catch up and the crawler's
+        # threads are stopped.
+        try:
+            if options.reindex:
+                self.updateDirectories(self.getAllImageDirectories(),
+                                       force = True)
+            elif not (options.singleImage or options.benchmark or
+                      options.batchDir):
+                # Start on all of them, so whichever gets chosen has a head
+                # start and the rest are ready next time. Benchmarks and
+                # batches index what they need themselves.
+                self.crawler.crawl(self.getAllImageDirectories())
+
+            if self.RenderCache:
+                self.cache = RenderCache(self.RenderCacheDir,
+                                         self.RenderCacheSize * 1024 * 1024,
+                                         self.RenderCacheFormat)
+
+            if options.benchmark:
+                benchmarks.run(self, options.benchmark, options)
+                return
+
+            if options.batchDir:
+                self.renderBatch(options)
+                return
+
+            if self.RenderProcesses > 0 and len(self.monitors) > 1:
+                self.startRenderPool()
+
+            if options.singleImage:
+                self.setWallpaperFromFile(options.singleImage)
+
+            elif options.monitors:
+                self.loadPreviousWallpaper()
+                self.setWallPaperFromDirList(options.monitors)
+
+            elif not options.change_time:
+                if not prerendered:
+                    self.setWallPaperFromConfigDirs()
+                if self.PrerenderNext:
+                    self.prerenderNext()
+            else:
+                WallpaperDaemon(self, options).run()
+        finally:
+            self.crawler.close()
 
 if __name__ == '__main__':
     d = Desktop()
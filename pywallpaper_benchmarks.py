@@ -0,0 +1,941 @@
+"""
+Benchmarks for multi-wallpaper.py, run with its -b option.
+
+Most work on a Desktop set up from the config and command line like any
+other run, pipeline and layout make up their own images and monitors.
+"""
+
+import os
+import sys
+import time
+import math
+import random
+import multiprocessing
+import json
+from ConfigParser import SafeConfigParser
+import ctypes
+
+from PIL import Image
+
+# multi-wallpaper.py can't be imported by name, -b imports this from it so
+# it is __main__ here, and in the processes multiprocessing starts.
+wallpaper = sys.modules['__main__']
+
+# These make up their own images and monitors, see Desktop.go().
+synthetic = ('pipeline', 'layout')
+
+def run(d, name, options):
+    """ Run the named benchmark on desktop d """
+    benchmarks = {
+        'fastload': benchmarkFastLoad,
+        'gradient': benchmarkGradient,
+        'streaming': benchmarkStreaming,
+        'pipeline': benchmarkPipeline,
+        'autocrop': benchmarkAutoCrop,
+        'fused': benchmarkFused,
+        'crawl': benchmarkCrawl,
+        'dedup': benchmarkDedup,
+        'paste': benchmarkPaste,
+        'startup': benchmarkStartup,
+        'layout': benchmarkLayout,
+        }
+    if name not in benchmarks:
+        print >> sys.stderr, "Unknown benchmark", name, \
+            "choose from", ", ".join(sorted(benchmarks))
+        return
+    benchmarks[name](d, options)
+
+def getWorkDir(*parts):
+    """ Where benchmarks keep their files, made if it isn't there """
+    workDir = os.path.abspath(os.path.join('pywallpaper_benchmark', *parts))
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    return workDir
+
+class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    _fields_ = [
+        ('cb', ctypes.c_ulong),
+        ('PageFaultCount', ctypes.c_ulong),
+        ('PeakWorkingSetSize', ctypes.c_size_t),
+        ('WorkingSetSize', ctypes.c_size_t),
+        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+        ('PagefileUsage', ctypes.c_size_t),
+        ('PeakPagefileUsage', ctypes.c_size_t)
+        ]
+
+def getPeakMemory():
+    """ Peak resident memory of this process in bytes, None if unknown """
+    windll = wallpaper.windll
+    if windll is not None:
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+        windll.psapi.GetProcessMemoryInfo(windll.kernel32.GetCurrentProcess(),
+                                          ctypes.byref(counters),
+                                          counters.cb)
+        return counters.PeakWorkingSetSize
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    # Everyone else reports kilobytes.
+    return peak * 1024
+
+def makeWallLayout(columns, rows, width, height):
+    """ A wallpaper.HeadlessBackend layout for a grid of identical monitors """
+    monitors = []
+    for row in range(rows):
+        for column in range(columns):
+            left = column * width
+            top = row * height
+            monitors.append({'rect': [left, top, left + width, top + height],
+                             'primary': not (row or column)})
+    return {'colour': [0, 0, 0], 'monitors': monitors}
+
+# The pipeline benchmark (benchmarkPipeline) renders a synthetic
+# library for synthetic layouts so that runs on different machines, or
+# before and after a change, render exactly the same thing.
+
+# (width, height, format, border) for each image in the library, the
+# borders are for Crop to find.
+benchmarkImages = [
+    (6000, 4000, 'JPEG', None),
+    (1920, 1080, 'JPEG', None),
+    (3000, 2000, 'PNG', None),
+    (1080, 1920, 'JPEG', None),
+    (4000, 1000, 'JPEG', None),
+    (800, 1200, 'BMP', None),
+    (2400, 1600, 'JPEG', (0, 0, 0)),
+    (1600, 2400, 'PNG', (255, 255, 255)),
+    ]
+
+benchmarkLayouts = [
+    ('single', [[0, 0, 1920, 1080]]),
+    ('left of primary', [[0, 0, 1920, 1080], [-1920, 0, 0, 1080]]),
+    ('portrait split', [[0, 0, 1920, 1080], [1920, 0, 3840, 1080],
+                        [-1080, -500, 0, 1420]]),
+    ('above split', [[0, 0, 2560, 1440], [-500, -1080, 1420, 0]]),
+    ('portrait panels', [[0, 0, 1080, 1920], [1080, 0, 2160, 1920],
+                         [-1080, 0, 0, 1920]]),
+    ]
+
+def makeBenchmarkLibrary(pathToLibrary, count = 24):
+    """ Write the benchmark images, unless they're already there """
+    if not os.path.isdir(pathToLibrary):
+        os.makedirs(pathToLibrary)
+    extensions = {'JPEG': 'jpg', 'PNG': 'png', 'BMP': 'bmp'}
+    images = []
+    for n in range(count):
+        width, height, format, border = benchmarkImages[n % len(benchmarkImages)]
+        pathToImage = os.path.join(pathToLibrary, 'bench%02d_%dx%d.%s' % (
+            n, width, height, extensions[format]))
+        images.append(pathToImage)
+        if os.path.exists(pathToImage):
+            continue
+
+        # Gradients for the broad shapes and noise for something to
+        # compress, different for every image but the same every run.
+        rng = random.Random(n)
+        inner = (width, height)
+        if border is not None:
+            inner = (width * 4 // 5, height * 4 // 5)
+        bands = [Image.linear_gradient('L').rotate(rng.randrange(360)),
+                 Image.radial_gradient('L'),
+                 Image.effect_noise((inner[0] // 4, inner[1] // 4),
+                                    rng.randrange(20, 80))]
+        img = Image.merge('RGB', [b.resize(inner, Image.BILINEAR)
+                                  for b in bands])
+        from PIL import ImageDraw
+        draw = ImageDraw.Draw(img)
+        for i in range(12):
+            x, y = rng.randrange(inner[0]), rng.randrange(inner[1])
+            draw.rectangle((x, y, x + rng.randrange(inner[0] // 4 + 1),
+                            y + rng.randrange(inner[1] // 4 + 1)),
+                           fill = tuple(rng.randrange(256) for c in 'rgb'))
+        if border is not None:
+            framed = Image.new('RGB', (width, height), border)
+            framed.paste(img, ((width - inner[0]) // 2,
+                               (height - inner[1]) // 2))
+            img = framed
+        img.save(pathToImage, format)
+    return images
+
+def makeBorderCases():
+    """ Synthetic bordered images for checking crop boxes against autoCrop """
+    from PIL import ImageDraw
+    cases = []
+
+    # A blank white page on a black border.
+    img = Image.new('RGB', (800, 600), (0, 0, 0))
+    img.paste((255, 255, 255), (100, 100, 700, 500))
+    cases.append(('white page', img))
+
+    # Black line art on white, letterboxed in black.
+    img = Image.new('RGB', (640, 480), (0, 0, 0))
+    page = Image.new('RGB', (503, 401), (255, 255, 255))
+    draw = ImageDraw.Draw(page)
+    for x in range(0, 503, 40):
+        draw.line((x, 0, 502 - x, 400), fill = (0, 0, 0))
+    img.paste(page, (68, 39))
+    cases.append(('line art', img))
+
+    # A white caption strip with black text above a photo.
+    rng = random.Random(0)
+    photo = Image.merge('RGB', [Image.radial_gradient('L'),
+                                Image.linear_gradient('L'),
+                                Image.effect_noise((256, 256), 40)]
+                        ).resize((800, 570), Image.BILINEAR)
+    img = Image.new('RGB', (800, 600), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    for i in range(20):
+        x = rng.randrange(20, 760)
+        draw.rectangle((x, 10, x + rng.randrange(2, 30), 20), fill = (0, 0, 0))
+    img.paste(photo, (0, 30))
+    cases.append(('caption', img))
+
+    # The white page again at photo size.
+    img = Image.new('RGB', (4000, 3000), (0, 0, 0))
+    img.paste((255, 255, 255), (500, 500, 3500, 2500))
+    cases.append(('big white page', img))
+
+    # Nothing at all, and one speck off a strip boundary, for the edge
+    # scan in Desktop.findEdges.
+    cases.append(('all black', Image.new('RGB', (640, 480), (0, 0, 0))))
+    img = Image.new('RGB', (640, 480), (0, 0, 0))
+    img.putpixel((317, 243), (200, 200, 200))
+    cases.append(('speck', img))
+    return cases
+
+def percentile(values, p):
+    """ Nearest rank percentile, p from 0 to 100 """
+    values = sorted(values)
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+def pipelineBenchmarkChild(settings, layout, pathToLibrary, workDir,
+                           rotations, results):
+    # Full rotations of one layout in their own process, so peak memory is
+    # just this layout's (see benchmarkPipeline).
+    random.seed(0)
+    d = wallpaper.Desktop.forRendering(
+        settings, backend = wallpaper.HeadlessBackend(layout))
+    d.config = SafeConfigParser()
+    # Just an interval, the second monitor still renders from d.dirs.
+    d.config.add_section('monitor_1')
+    d.config.set('monitor_1', 'interval', '5')
+    d.dirs = [pathToLibrary]
+    d.outputPath = os.path.join(workDir, 'pipeline.bmp')
+
+    # A fresh index and deck so every run shows the same images.
+    pathToIndex = os.path.join(workDir, 'pipeline.db')
+    if os.path.exists(pathToIndex):
+        os.remove(pathToIndex)
+    d.index = wallpaper.ImageIndex(pathToIndex)
+    d.deck = wallpaper.RotationDeck(d.index)
+    d.index.update(d.dirs)
+
+    # Enumerating and placing the monitors.
+    start = time.time()
+    for i in range(200):
+        d.setMonitorExtents()
+    layoutTime = (time.time() - start) / 200
+
+    d.createEmptyWallpaper()
+    d.stats.enabled = True
+    baseline = getPeakMemory()
+
+    latencies = []
+    for i in range(rotations):
+        start = time.time()
+        d.applyFrame(d.renderFrame())
+        latencies.append(time.time() - start)
+
+    peak = getPeakMemory()
+    counters, stages = d.stats.takePending()
+    os.remove(d.outputPath)
+    results.put({
+        'monitors': len(d.monitors),
+        'rotations': rotations,
+        'rotationsPerSecond': rotations / sum(latencies),
+        'megapixelsPerSecond': (rotations * d.wSize[0] * d.wSize[1] /
+                                sum(latencies) / 1e6),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies),
+        'peakMB': peak is not None and (peak - baseline) / 1048576.0 or None,
+        'layoutSeconds': layoutTime,
+        'stages': dict((name, seconds / calls)
+                       for name, (calls, seconds, longest) in stages.items()),
+        })
+
+def renderBenchmarkChild(settings, images, sizes, results):
+    # Renders every image for every size in its own process, for measuring
+    # peak memory (see benchmarkFused).
+    d = wallpaper.Desktop.forRendering(settings)
+    monitors = [wallpaper.Monitor(0, [0, 0, w, h], [0, 0, w, h], 1)
+                for w, h in sizes]
+    for pathToImage in images:
+        # Get the files into the OS cache so both modes read them the same.
+        Image.open(pathToImage).load()
+    baseline = getPeakMemory()
+
+    start = time.time()
+    for pathToImage in images:
+        for monitor in monitors:
+            d.renderWallPaperFromFile(pathToImage, monitor)
+    results.put((time.time() - start, baseline, getPeakMemory()))
+
+def compositeBenchmarkChild(settings, layout, images, workDir, results):
+    # One render of a whole desktop in its own process, for measuring peak
+    # memory (see benchmarkStreaming).
+    d = wallpaper.Desktop.forRendering(
+        settings, backend = wallpaper.HeadlessBackend(layout))
+    d.setMonitorExtents()
+    d.outputPath = os.path.join(workDir, 'benchmark.bmp')
+    baseline = getPeakMemory()
+
+    start = time.time()
+    if d.Streaming:
+        d.compositor = wallpaper.StreamingCompositor(
+            os.path.join(workDir, 'tiles'))
+    d.createEmptyWallpaper()
+    frame = []
+    for n, monitor in enumerate(d.monitors):
+        img = d.createWallPaperFromFile(images[n % len(images)], monitor)
+        frame.append((monitor, d.keepWallpaper(monitor, img)))
+        img = None
+    d.applyFrame(frame)
+    results.put((time.time() - start, baseline, getPeakMemory()))
+    # These get big, no need to keep one about.
+    os.remove(d.outputPath)
+
+def makeRandomMonitors(rng, count, cell = 1920):
+    """ count monitors scattered over a grid, the primary anywhere """
+    # Each monitor is up to a cell in size from the top left of its cell,
+    # so they never overlap but rarely line up either (see
+    # benchmarkLayout).
+    columns = int(math.ceil(math.sqrt(count * 1.5)))
+    rects = []
+    for c in rng.sample(range(columns * columns), count):
+        x, y = (c % columns) * cell, (c // columns) * cell
+        rects.append((x, y, x + rng.randint(cell // 2, cell),
+                      y + rng.randint(cell // 2, cell)))
+    primary = rng.randrange(count)
+    # Windows always has the primary at 0, 0, a layout file needn't.
+    dx, dy = rects[primary][:2]
+    if rng.random() < 0.5:
+        dx = rng.randint(-cell * columns, cell * columns)
+        dy = rng.randint(-cell * columns, cell * columns)
+    return [wallpaper.Monitor(n, (l - dx, t - dy, r - dx, b - dy),
+                              (l - dx, t - dy, r - dx, b - dy),
+                              int(n == primary))
+            for n, (l, t, r, b) in enumerate(rects)]
+
+# Run in a fresh interpreter with the path to multi-wallpaper.py, prints
+# JSON of what importing it imported and what each import cost, much like
+# python 3's -X importtime (see benchmarkStartup).
+importTimer = r'''
+import sys, time, imp, __builtin__
+realImport = __builtin__.__import__
+timings = []
+inner = [0.0]
+def timedImport(name, *args):
+    before = len(sys.modules)
+    inner.append(0.0)
+    start = time.time()
+    try:
+        return realImport(name, *args)
+    finally:
+        cumulative = time.time() - start
+        nested = inner.pop()
+        inner[-1] += cumulative
+        if len(sys.modules) > before:
+            if len(args) > 2 and args[2]:
+                name = '%s (%s)' % (name or '.', ', '.join(args[2]))
+            timings.append((name, cumulative - nested, cumulative))
+__builtin__.__import__ = timedImport
+imp.load_source('pywallpaper', sys.argv[1])
+__builtin__.__import__ = realImport
+import json
+json.dump({'modules': timings, 'loaded': sorted(sys.modules)}, sys.stdout)
+'''
+
+def drawGradientByLine(size, top, bottom):
+    # The original line at a time gradient, only kept as the reference
+    # for benchmarkGradient.
+    bgImage = Image.new('RGB', size)
+    width, height = size
+    fh = float(height)
+
+    r1, g1, b1 = top
+    r, g, b = bottom
+    rs = float(r1 - r) / fh
+    gs = float(g1 - g) / fh
+    bs = float(b1 - b) / fh
+
+    from PIL import ImageDraw
+    draw = ImageDraw.Draw(bgImage)
+    for h in range(0, height):
+        draw.line((0, h, width, h),
+                  fill = (int(r1), int(g1), int(b1)))
+        r1 -= rs
+        b1 -= bs
+        g1 -= gs
+    return bgImage
+
+def autoCrop(im, bgcolor = (0, 0, 0)):
+    from PIL import ImageChops, ImageOps
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    im2 = ImageOps.autocontrast(im, 5)
+    bg = Image.new("RGB", im.size, bgcolor)
+    diff = ImageChops.difference(im2, bg)
+    bbox = diff.getbbox()
+    if bbox:
+        return im.crop(bbox)
+    return im # no contents
+
+def getBenchmarkImages(d, options, count = 20):
+    if options.singleImage:
+        return [options.singleImage]
+    images = d.getAllImages()
+    # The same images every run so that runs can be compared.
+    images.sort()
+    random.Random(0).shuffle(images)
+    return images[:count]
+
+def benchmarkFastLoad(d, options):
+    """ Time and quality of rendering with and without FastLoad """
+    from PIL import ImageChops, ImageStat
+    sizes = sorted(set(tuple(m.size) for m in d.monitors))
+    fastLoad = d.FastLoad
+    totals = [0.0, 0.0]
+
+    print '%-40s %-11s %8s %8s %8s' % ('image', 'monitor', 'full (s)',
+                                       'fast (s)', 'PSNR dB')
+    try:
+        for pathToImage in getBenchmarkImages(d, options):
+            for width, height in sizes:
+                monitor = wallpaper.Monitor(0, [0, 0, width, height],
+                                            [0, 0, width, height], 1)
+                results = []
+                for d.FastLoad in (False, True):
+                    start = time.time()
+                    img = d.renderWallPaperFromFile(pathToImage, monitor)
+                    results.append((time.time() - start, img))
+                (fullTime, fullImg), (fastTime, fastImg) = results
+                totals[0] += fullTime
+                totals[1] += fastTime
+
+                # Peak signal to noise ratio of the fast render against
+                # the full one, above 40dB is hard to tell apart.
+                diff = ImageChops.difference(fullImg, fastImg)
+                mse = sum(r * r for r in ImageStat.Stat(diff).rms) / 3.0
+                psnr = float('inf')
+                if mse:
+                    psnr = 10 * math.log10(255.0 * 255.0 / mse)
+
+                print '%-40s %-11s %8.3f %8.3f %8.1f' % (
+                    os.path.basename(pathToImage)[-40:],
+                    '%dx%d' % (width, height), fullTime, fastTime, psnr)
+    finally:
+        d.FastLoad = fastLoad
+
+    print '%-52s %8.3f %8.3f' % ('total', totals[0], totals[1])
+
+def benchmarkFused(d, options):
+    """ Time, peak memory and difference of fused and legacy rendering """
+    from PIL import ImageChops, ImageStat
+    images = getBenchmarkImages(d, options)
+    sizes = sorted(set(tuple(m.size) for m in d.monitors) |
+                   set([(1920, 1080), (3840, 2160), (1080, 1920)]))
+    settings = d.getRenderSettings()
+
+    print '%-10s %9s %10s' % ('mode', 'time (s)', 'peak (MB)')
+    for fused in (False, True):
+        settings['FusedRender'] = fused
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target = renderBenchmarkChild,
+                                        args = (settings, images, sizes,
+                                                results))
+        child.start()
+        child.join()
+        if child.exitcode != 0:
+            raise Exception("Benchmark render failed")
+        seconds, baseline, peak = results.get()
+        if peak is None:
+            used = 'n/a'
+        else:
+            used = '%10.1f' % ((peak - baseline) / 1048576.0)
+        print '%-10s %9.3f %10s' % (fused and 'fused' or 'legacy',
+                                    seconds, used)
+
+    # How far apart they come out, the resize is on slightly different
+    # pixel boundaries so small differences are expected.
+    fusedRender = d.FusedRender
+    worst = 0
+    total = 0.0
+    try:
+        for pathToImage in images:
+            for width, height in sizes:
+                monitor = wallpaper.Monitor(0, [0, 0, width, height],
+                                            [0, 0, width, height], 1)
+                rendered = []
+                for d.FusedRender in (False, True):
+                    rendered.append(
+                        d.renderWallPaperFromFile(pathToImage, monitor))
+                diff = ImageChops.difference(*rendered)
+                worst = max([worst] + [hi for lo, hi in diff.getextrema()])
+                total += sum(ImageStat.Stat(diff).mean) / 3.0
+    finally:
+        d.FusedRender = fusedRender
+    print 'max diff %d, mean diff %.3f' % (
+        worst, total / (len(images) * len(sizes)))
+
+def benchmarkAutoCrop(d, options):
+    """ Time finding borders with autoCrop and findContentBox """
+    from PIL import ImageChops, ImageOps
+    print '%-40s %-11s %9s %9s %8s' % ('image', 'cropped', 'old (s)',
+                                       'new (s)', 'max diff')
+    totals = [0.0, 0.0]
+    # Awkward borders first, then real pictures.
+    cases = makeBorderCases()
+    for pathToImage in getBenchmarkImages(d, options):
+        cases.append((os.path.basename(pathToImage),
+                      Image.open(pathToImage).convert('RGB')))
+    worst = 0
+    for name, image in cases:
+        start = time.time()
+        autoCrop(autoCrop(image, (0, 0, 0)), (255, 255, 255))
+        oldTime = time.time() - start
+        # autoCrop only hands back the cropped image, so repeat its
+        # work for the box.
+        oldBox = (0, 0) + image.size
+        for colour in ((0, 0, 0), (255, 255, 255)):
+            part = image.crop(oldBox)
+            found = ImageChops.difference(
+                ImageOps.autocontrast(part, 5),
+                Image.new('RGB', part.size, colour)).getbbox()
+            if found:
+                oldBox = (oldBox[0] + found[0], oldBox[1] + found[1],
+                          oldBox[0] + found[2], oldBox[1] + found[3])
+
+        start = time.time()
+        newBox = d.findContentBox(image)
+        newTime = time.time() - start
+
+        totals[0] += oldTime
+        totals[1] += newTime
+        diff = max(abs(a - b) for a, b in zip(oldBox, newBox))
+        worst = max(worst, diff)
+        print '%-40s %-11s %9.3f %9.3f %8d' % (
+            name[-40:], '%dx%d' % (newBox[2] - newBox[0],
+                                   newBox[3] - newBox[1]),
+            oldTime, newTime, diff)
+    print '%-52s %9.3f %9.3f' % ('total', totals[0], totals[1])
+    if worst:
+        raise Exception("findContentBox doesn't match autoCrop")
+
+def benchmarkCrawl(d, options):
+    """ Time indexing the image directories serially and on threads """
+    # Each run starts with an empty index, then goes again with nothing
+    # changed. first is how long before a wallpaper could be chosen.
+    dirs = d.getAllImageDirectories()
+    workDir = getWorkDir()
+    pathToIndex = os.path.join(workDir, 'crawl.db')
+
+    print '%-10s %9s %9s %9s %8s' % ('threads', 'first (s)', 'cold (s)',
+                                     'warm (s)', 'images')
+    for threads in (0, 1, 4, d.CrawlThreads):
+        if os.path.exists(pathToIndex):
+            os.remove(pathToIndex)
+        index = wallpaper.ImageIndex(pathToIndex)
+        crawler = None
+        if threads:
+            crawler = wallpaper.DirectoryCrawler(pathToIndex, threads,
+                                                 d.CrawlTimeout,
+                                                 d.Recursive)
+        times = []
+        first = None
+        for run in range(2):
+            start = time.time()
+            if crawler is None:
+                for pathToDir in dirs:
+                    index.updateDirectory(pathToDir,
+                                          recursive = d.Recursive)
+                    if first is None and index.hasImages(pathToDir,
+                                                         d.Recursive):
+                        first = time.time() - start
+            else:
+                crawler.crawl(dirs)
+                if first is None:
+                    crawler.wait(dirs[0], partial = True)
+                    first = time.time() - start
+                for pathToDir in dirs:
+                    crawler.wait(pathToDir)
+            times.append(time.time() - start)
+        if crawler is not None:
+            crawler.close()
+        count = sum(len(index.getImages(pathToDir, d.Recursive))
+                    for pathToDir in dirs)
+        print '%-10s %9.3f %9.3f %9.3f %8d' % (
+            threads or 'serial', first or 0.0, times[0], times[1], count)
+
+def benchmarkDedup(d, options):
+    """ Time hashing and grouping the image directories """
+    # Each crawl starts with an empty index, the difference is the cost
+    # of hashing.
+    dirs = d.getAllImageDirectories()
+    workDir = getWorkDir()
+    pathToIndex = os.path.join(workDir, 'dedup.db')
+
+    times = []
+    for dedup in (False, True):
+        if os.path.exists(pathToIndex):
+            os.remove(pathToIndex)
+        crawler = wallpaper.DirectoryCrawler(pathToIndex, d.CrawlThreads,
+                                             d.CrawlTimeout, d.Recursive,
+                                             dedup = dedup,
+                                             distance = d.DedupDistance)
+        start = time.time()
+        crawler.crawl(dirs)
+        for pathToDir in dirs:
+            crawler.wait(pathToDir)
+        times.append(time.time() - start)
+        crawler.close()
+
+    index = wallpaper.ImageIndex(pathToIndex)
+    start = time.time()
+    groups, hidden = index.groupDuplicates(d.DedupDistance)
+    groupTime = time.time() - start
+    images = sum(len(index.getImages(pathToDir, d.Recursive))
+                 for pathToDir in dirs)
+
+    print 'crawl %.3fs, with hashing %.3fs, grouping %.3fs' % (
+        times[0], times[1], groupTime)
+    print '%d images, %d groups of near duplicates, %d images hidden, ' \
+          '%d left to rotate through' % (images, groups, hidden,
+                                         images - hidden)
+
+def benchmarkPaste(d, options):
+    """ Time getting a rendered wallpaper onto the desktop image """
+    # Each monitor's wallpaper rendered from scratch, decoded from a PNG
+    # cache entry or mapped from a RAW one, then pasted. Entries are
+    # read back straight after they're written, so from the page cache
+    # as they would be on a busy rotation.
+    images = getBenchmarkImages(d, options, 8)
+    workDir = getWorkDir()
+    settings = d.getRenderSettings()
+    bgImage = Image.new('RGB', d.wSize)
+    caches = []
+    for format in ('PNG', 'RAW'):
+        pathToCache = os.path.join(workDir, 'paste_' + format.lower())
+        if os.path.isdir(pathToCache):
+            for f in os.listdir(pathToCache):
+                os.remove(os.path.join(pathToCache, f))
+        caches.append((format, wallpaper.RenderCache(pathToCache, 1 << 40,
+                                                     format)))
+
+    # source: ([get], [paste], [entry bytes])
+    results = dict((name, ([], [], [])) for name in ('none', 'PNG', 'RAW'))
+    def paste(name, got, img, entryBytes = 0):
+        start = time.time()
+        monitor.addWallpaper(bgImage, img)
+        results[name][0].append(got)
+        results[name][1].append(time.time() - start)
+        results[name][2].append(entryBytes)
+
+    for pathToImage in images:
+        for monitor in d.monitors:
+            start = time.time()
+            img = d.renderWallPaperFromFile(pathToImage, monitor)
+            if img is None:
+                continue
+            paste('none', time.time() - start, img)
+            for format, cache in caches:
+                key = cache.makeKey(pathToImage, monitor.size, settings)
+                cache.put(key, img)
+                start = time.time()
+                cached = cache.get(key)
+                paste(format, time.time() - start, cached,
+                      os.path.getsize(cache.getPath(key)))
+                del cached
+
+    print '%-6s %12s %12s %12s %10s' % ('cache', 'get (ms)', 'paste (ms)',
+                                        'both p90', 'entry (MB)')
+    for name in ('none', 'PNG', 'RAW'):
+        gets, pastes, sizes = results[name]
+        if not gets:
+            continue
+        totals = [g + p for g, p in zip(gets, pastes)]
+        print '%-6s %12.2f %12.2f %12.2f %10.2f' % (
+            name, percentile(gets, 50) * 1000.0,
+            percentile(pastes, 50) * 1000.0,
+            percentile(totals, 90) * 1000.0,
+            sum(sizes) / float(len(sizes)) / 1048576.0)
+
+def benchmarkStartup(d, options):
+    """ Time starting up, and what each import costs """
+    # Everything in fresh interpreters, a one-shot run is mostly start
+    # up. With a layout file, also times one-shot runs of this config,
+    # with PrerenderNext the later ones put up the last one's wallpaper.
+    import subprocess
+    python = sys.executable
+    script = os.path.abspath(wallpaper.__file__)
+
+    def run(args, runs = 5):
+        times = []
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call(args)
+            times.append(time.time() - start)
+        return percentile(times, 50)
+
+    bare = run([python, '-c', 'pass'])
+    loaded = run([python, '-c', 'import imp, sys; '
+                  'imp.load_source("pywallpaper", sys.argv[1])', script])
+    print '%-36s %10.1f' % ('interpreter (ms)', bare * 1000.0)
+    print '%-36s %10.1f' % ('interpreter and import (ms)',
+                            loaded * 1000.0)
+
+    output = subprocess.Popen([python, '-c', importTimer, script],
+                              stdout = subprocess.PIPE).communicate()[0]
+    timings = json.loads(output)
+    print
+    print '%-36s %10s %10s' % ('import', 'self (ms)', 'cumulative')
+    for name, own, cumulative in sorted(timings['modules'],
+                                        key = lambda t: -t[2])[:20]:
+        print '%-36s %10.1f %10.1f' % (name[:36], own * 1000.0,
+                                       cumulative * 1000.0)
+
+    # Only needed for cropping, gradients, benchmarks or the registry.
+    lazy = ['pywallpaper_benchmarks', 'PIL.ImageDraw', 'PIL.ImageChops',
+            'PIL.ImageOps', 'PIL.ImageFilter', 'PIL.ImageStat', 'win32api', 'win32con']
+    eager = [name for name in lazy if name in timings['loaded']]
+    print 'imported before they are needed: %s' % (', '.join(eager) or
+                                                   'none')
+
+    pathToLayout = getattr(d.backend, 'pathToLayout', None)
+    if pathToLayout is None:
+        print 'give a layout (-l) to time one-shot runs'
+        return
+    workDir = getWorkDir('startup')
+    pathToOutput = d.writer.getPath(workDir, 'startup')
+    # The metrics line is written as the wallpaper goes up, before
+    # anything is prerendered.
+    pathToMetrics = os.path.join(workDir, 'startup.jsonl')
+    args = [python, script, '-c', d.configFile, '-l', pathToLayout,
+            '-w', workDir, '-o', pathToOutput, '--metrics', pathToMetrics]
+    for pathToDir in options.directories:
+        args += ['-d', pathToDir]
+    print
+    print '%-36s %10s %10s' % ('one-shot run', 'up (ms)', 'exit (ms)')
+    for n in range(4):
+        waiting = os.path.exists(pathToOutput + '.next.json')
+        start = time.time()
+        seconds = run(args, 1)
+        f = open(pathToMetrics, 'rb')
+        try:
+            up = json.loads(f.readlines()[-1])['time'] - start
+        finally:
+            f.close()
+        print '%-36s %10.1f %10.1f' % (
+            '%d%s' % (n + 1, waiting and ' (prerendered)' or ''),
+            up * 1000.0, seconds * 1000.0)
+
+def benchmarkLayout(d, options):
+    """ Time placing 64 monitor layouts """
+    # Random layouts with the primary anywhere, see makeRandomMonitors.
+    # test_layout.py checks the placements are right.
+    rng = random.Random(0)
+    times = []
+    for n in range(100):
+        monitors = makeRandomMonitors(rng, 64)
+        start = time.time()
+        wallpaper.Layout(monitors)
+        times.append(time.time() - start)
+
+    print '%-32s %10.1f' % ('layout of 64 (us)',
+                            percentile(times, 50) * 1000000.0)
+    print '%-32s %10.1f' % ('layout of 64, p90 (us)',
+                            percentile(times, 90) * 1000000.0)
+
+def benchmarkGradient(d, options):
+    """ Time building the gradient background at a few desktop sizes """
+    from PIL import ImageChops
+    sizes = [(1920, 1080), (5760, 1080), (7680, 2160), (11520, 2160)]
+    if tuple(d.wSize) not in sizes:
+        sizes.append(tuple(d.wSize))
+    top, bottom = d.getGradientColours(d.bgColour)
+
+    print '%-11s %9s %9s %9s %8s' % ('desktop', 'line (s)', 'column (s)',
+                                    'cached (s)', 'max diff')
+    for size in sizes:
+        start = time.time()
+        byLine = drawGradientByLine(size, top, bottom)
+        lineTime = time.time() - start
+
+        start = time.time()
+        byColumn = d.renderEmptyWallpaper(size, d.bgColour, True)
+        columnTime = time.time() - start
+
+        # What every later wallpaper pays with the canvas cached.
+        start = time.time()
+        byColumn.copy()
+        copyTime = time.time() - start
+
+        extrema = ImageChops.difference(byLine, byColumn).getextrema()
+        print '%-11s %9.4f %9.4f %9.4f %8d' % (
+            '%dx%d' % size, lineTime, columnTime, copyTime,
+            max(hi for lo, hi in extrema))
+
+def getLayout(d):
+    """ The current monitors of d as a HeadlessBackend layout """
+    return {'colour': list(d.bgColour),
+            'monitors': [{'rect': list(m.physical),
+                          'primary': m.isPrimary}
+                         for m in d.monitors]}
+
+# Settings for the pipeline benchmark, fixed so that results only
+# change when the code does.
+pipelineSettings = {'Blending': True, 'BlendRatio': 0.4,
+                    'bgColour': (0, 0, 0), 'Crop': True, 'Fill': True,
+                    'PreRotate': True, 'FastLoad': True,
+                    'Gradient': True, 'OutputFormat': 'BMP',
+                    'OutputQuality': 95, 'RenderCache': False,
+                    'FusedRender': True, 'MaxPixels': 100.0}
+pipelineRotations = 10
+# Lower is better for these, more than this much worse is a regression.
+pipelineMetrics = ('p50', 'p90', 'p99', 'peakMB', 'layoutSeconds')
+pipelineTolerance = 0.10
+
+def benchmarkPipeline(d, options):
+    """ Full headless rotations of a synthetic library and layouts """
+    workDir = getWorkDir()
+    print >> sys.stderr, "Making the benchmark library"
+    pathToLibrary = os.path.join(workDir, 'library')
+    makeBenchmarkLibrary(pathToLibrary)
+
+    layouts = [(name, {'colour': [0, 0, 0],
+                       'monitors': [{'rect': r, 'primary': not n}
+                                    for n, r in enumerate(rects)]})
+               for name, rects in benchmarkLayouts]
+    layouts.append(('3x2 wall', makeWallLayout(3, 2, 1920, 1080)))
+
+    results = {}
+    print '%-16s %4s %7s %7s %8s %8s %8s %9s %9s' % (
+        'layout', 'mons', 'rot/s', 'MP/s', 'p50 (ms)', 'p90 (ms)',
+        'p99 (ms)', 'peak (MB)', 'calc (us)')
+    for name, layout in layouts:
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target = pipelineBenchmarkChild,
+            args = (pipelineSettings, layout, pathToLibrary, workDir,
+                    pipelineRotations, queue))
+        child.start()
+        child.join()
+        if child.exitcode != 0:
+            raise Exception("Benchmark render failed for %s" % name)
+        r = results[name] = queue.get()
+        print '%-16s %4d %7.2f %7.1f %8.1f %8.1f %8.1f %9s %9.1f' % (
+            name, r['monitors'], r['rotationsPerSecond'],
+            r['megapixelsPerSecond'], r['p50'] * 1000, r['p90'] * 1000,
+            r['p99'] * 1000,
+            r['peakMB'] is None and 'n/a' or '%.1f' % r['peakMB'],
+            r['layoutSeconds'] * 1e6)
+
+    stages = sorted(set(stage for r in results.values()
+                        for stage in r['stages']))
+    print
+    print '%-16s' % 'mean (ms)' + ''.join('%10s' % s[:9] for s in stages)
+    for name, layout in layouts:
+        print '%-16s' % name + ''.join(
+            '%10.1f' % (results[name]['stages'].get(s, 0) * 1000)
+            for s in stages)
+
+    record = {'time': time.time(), 'python': sys.version.split()[0],
+              'settings': pipelineSettings, 'results': results}
+    wallpaper.saveJson(os.path.join(workDir, 'pipeline.json'), record)
+    if options.baseline:
+        baseline = wallpaper.loadJson(options.baseline)
+        if baseline is not None:
+            comparePipeline(baseline, record)
+        else:
+            wallpaper.saveJson(options.baseline, record)
+            print >> sys.stderr, "Saved baseline", options.baseline
+
+def comparePipeline(baseline, record):
+    """ Print how each metric moved since baseline, flag regressions """
+    print
+    print '%-16s %-14s %10s %10s %8s' % ('layout', 'metric (ms, MB)',
+                                          'baseline', 'now', 'change')
+    regressions = 0
+    for name in sorted(record['results']):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        new = record['results'][name]
+        metrics = [(m, old.get(m), new.get(m)) for m in pipelineMetrics]
+        metrics += [('stage ' + s, old['stages'].get(s), seconds)
+                    for s, seconds in sorted(new['stages'].items())]
+        for metric, before, now in metrics:
+            if not before or now is None:
+                continue
+            if metric != 'peakMB':
+                before *= 1000
+                now *= 1000
+            change = (now - before) / before
+            flag = ''
+            # Anything under a millisecond (or megabyte) is just noise.
+            if change > pipelineTolerance and now - before > 1:
+                flag = ' REGRESSION'
+                regressions += 1
+            print '%-16s %-14s %10.3f %10.3f %+7.1f%%%s' % (
+                name, metric[:14], before, now, change * 100, flag)
+    # Through json so the tuples are lists, as they are in the baseline.
+    if baseline.get('settings') != json.loads(json.dumps(record['settings'])):
+        print >> sys.stderr, "Baseline used different settings"
+    print >> sys.stderr, regressions, "regressions over", \
+        '%d%%' % (pipelineTolerance * 100)
+
+def benchmarkStreaming(d, options):
+    """ Peak memory and time building the wallpaper in memory or streaming """
+    # Peak memory only ever goes up, so each run gets its own process.
+    images = getBenchmarkImages(d, options, 4)
+    layouts = [('this desktop', getLayout(d)),
+               ('4x4 1080p wall', makeWallLayout(4, 4, 1920, 1080)),
+               ('6x3 4k wall', makeWallLayout(6, 3, 3840, 2160))]
+    settings = d.getRenderSettings()
+    settings.update(Gradient = d.Gradient, OutputFormat = 'BMP',
+                    OutputQuality = d.OutputQuality)
+    workDir = getWorkDir()
+
+    print '%-16s %-10s %10s %10s' % ('layout', 'mode', 'time (s)',
+                                     'peak (MB)')
+    for name, layout in layouts:
+        for streaming in (False, True):
+            results = multiprocessing.Queue()
+            settings['Streaming'] = streaming
+            child = multiprocessing.Process(
+                target = compositeBenchmarkChild,
+                args = (settings, layout, images, workDir, results))
+            child.start()
+            child.join()
+            if child.exitcode != 0:
+                raise Exception("Benchmark render failed for %s" % name)
+            seconds, baseline, peak = results.get()
+            if peak is None:
+                used = 'n/a'
+            else:
+                used = '%10.1f' % ((peak - baseline) / 1048576.0)
+            print '%-16s %-10s %10.3f %10s' % (
+                name, streaming and 'streaming' or 'in memory', seconds,
+                used)
+
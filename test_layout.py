@@ -0,0 +1,159 @@
+"""
+Checks Monitor and Layout place every monitor where Windows will show it.
+
+Run with python -m unittest test_layout (python 2.7).
+"""
+
+import os
+import imp
+import math
+import pickle
+import random
+import unittest
+
+from PIL import Image, ImageChops
+
+# The script's name has a dash in it, so it can't just be imported.
+wallpaper = imp.load_source(
+    'pywallpaper', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'multi-wallpaper.py'))
+Monitor = wallpaper.Monitor
+Layout = wallpaper.Layout
+
+def makeRandomMonitors(rng, count, cell = 1920):
+    """ count monitors scattered over a grid, the primary anywhere """
+    # Each monitor is up to a cell in size from the top left of its cell,
+    # so they never overlap but rarely line up either.
+    columns = int(math.ceil(math.sqrt(count * 1.5)))
+    rects = []
+    for c in rng.sample(range(columns * columns), count):
+        x, y = (c % columns) * cell, (c // columns) * cell
+        rects.append((x, y, x + rng.randint(cell // 2, cell),
+                      y + rng.randint(cell // 2, cell)))
+    primary = rng.randrange(count)
+    # Windows always has the primary at 0, 0, a layout file needn't.
+    dx, dy = rects[primary][:2]
+    if rng.random() < 0.5:
+        dx = rng.randint(-cell * columns, cell * columns)
+        dy = rng.randint(-cell * columns, cell * columns)
+    return [Monitor(n, (l - dx, t - dy, r - dx, b - dy),
+                    (l - dx, t - dy, r - dx, b - dy), int(n == primary))
+            for n, (l, t, r, b) in enumerate(rects)]
+
+class LayoutTest(unittest.TestCase):
+
+    def setUp(self):
+        # The same layouts every run.
+        self.rng = random.Random(0)
+
+    def checkPlacements(self, layout):
+        width, height = layout.size
+        originX, originY = layout.origin
+        parts = []
+        for m in layout.monitors:
+            area = 0
+            for (x0, y0, x1, y1), (toX, toY) in m.placements:
+                area += (x1 - x0) * (y1 - y0)
+                self.assertTrue(0 <= x0 < x1 <= m.width and
+                                0 <= y0 < y1 <= m.height,
+                                '%r: part %r outside the monitor'
+                                % (m, (x0, y0, x1, y1)))
+                self.assertTrue(0 <= toX and toX + x1 - x0 <= width and
+                                0 <= toY and toY + y1 - y0 <= height,
+                                '%r: part at %r off the image'
+                                % (m, (toX, toY)))
+                # Where tiling from the primary puts this bit of the monitor.
+                self.assertEqual((toX, toY),
+                                 ((m.left + x0 - originX) % width,
+                                  (m.top + y0 - originY) % height))
+                parts.append((toX, toY, toX + x1 - x0, toY + y1 - y0, m))
+            self.assertEqual(area, m.width * m.height,
+                             '%r: parts cover %d pixels' % (m, area))
+            self.assertEqual(m.needsSplit, len(m.placements) > 1)
+            if m.isPrimary:
+                self.assertEqual(m.position, (0, 0))
+
+        # The monitors don't overlap, so neither should their wallpapers.
+        parts.sort()
+        for i, (left, top, right, bottom, m) in enumerate(parts):
+            for other in parts[i + 1:]:
+                if other[0] >= right:
+                    break
+                self.assertFalse(other[1] < bottom and top < other[3],
+                                 '%r and %r overlap' % (m, other[4]))
+
+    def testRandomLayouts(self):
+        for n in range(100):
+            self.checkPlacements(Layout(makeRandomMonitors(self.rng, 64)))
+
+    def testLeftOfPrimary(self):
+        # The image is tiled from the primary, so the monitor to its left
+        # wraps round to the right of the image.
+        layout = Layout([Monitor(0, (0, 0, 1920, 1080), (0, 0, 1920, 1040), 1),
+                         Monitor(1, (-1080, -500, 0, 1420),
+                                 (-1080, -500, 0, 1420), 0)])
+        self.assertEqual(layout.size, (3000, 1920))
+        self.assertEqual(layout.origin, (0, 0))
+        primary, left = layout.monitors
+        self.assertEqual(primary.position, (0, 0))
+        self.assertFalse(primary.needsSplit)
+        self.assertEqual(left.position, (1920, 1420))
+        self.assertEqual(left.placements,
+                         (((0, 0, 1080, 500), (1920, 1420)),
+                          ((0, 500, 1080, 1920), (1920, 0))))
+        self.checkPlacements(layout)
+
+    def testNoPrimary(self):
+        # Without one the first monitor is tiled from.
+        layout = Layout([Monitor(0, (100, 0, 200, 100), (100, 0, 200, 100), 0),
+                         Monitor(1, (0, 0, 100, 100), (0, 0, 100, 100), 0)])
+        self.assertEqual(layout.origin, (100, 0))
+        self.assertEqual([m.position for m in layout.monitors],
+                         [(0, 0), (100, 0)])
+        self.checkPlacements(layout)
+
+    def testNoMonitors(self):
+        self.assertRaises(Exception, Layout, [])
+
+    def testEquality(self):
+        # Equal layouts are equal keys, moving a monitor isn't.
+        for n in range(20):
+            monitors = makeRandomMonitors(self.rng, 8)
+            layout = Layout(monitors)
+            self.assertEqual(Layout(list(monitors)), layout)
+            self.assertEqual(hash(Layout(monitors)), hash(layout))
+            self.assertEqual(pickle.loads(pickle.dumps(layout, 2)), layout)
+            self.assertEqual(pickle.loads(pickle.dumps(layout.monitors[0], 2)),
+                             layout.monitors[0])
+            moved = list(monitors)
+            moved[0] = Monitor(0, [v + 1 for v in monitors[0].physical],
+                               monitors[0].working, moved[0].isPrimary)
+            self.assertNotEqual(Layout(moved), layout)
+
+    def testImmutable(self):
+        layout = Layout(makeRandomMonitors(self.rng, 4))
+        self.assertRaises(AttributeError, setattr, layout.monitors[0],
+                          'left', 0)
+        self.assertRaises(AttributeError, setattr, layout, 'size', (1, 1))
+
+    def testPaintAndReadBack(self):
+        # Each monitor's wallpaper goes on the image and comes back out
+        # unchanged, however it was split.
+        for n in range(20):
+            layout = Layout(makeRandomMonitors(self.rng, 64, 48))
+            bgImage = Image.new('RGB', layout.size)
+            images = []
+            for m in layout.monitors:
+                img = Image.merge('RGB', (
+                    Image.linear_gradient('L').resize(m.size),
+                    Image.linear_gradient('L').rotate(90).resize(m.size),
+                    Image.new('L', m.size, m.monitor * 4)))
+                m.addWallpaper(bgImage, img)
+                images.append(img)
+            for m, img in zip(layout.monitors, images):
+                self.assertEqual(ImageChops.difference(
+                    m.getWallpaper(bgImage), img).getbbox(), None,
+                                 '%r: wallpaper not read back' % (m))
+
+if __name__ == '__main__':
+    unittest.main()